@@ -1,31 +1,104 @@
 #!/usr/bin/env python
 import argparse
+import asyncio
+import base64
+import collections
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import ipaddress
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import shlex
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
+from concurrent import futures
 from datetime import datetime
+from datetime import timezone
 
 import grpc
 import yaml
-from google.protobuf.json_format import Parse
+from google.protobuf import descriptor_pb2
+from google.protobuf import descriptor_pool
+from google.protobuf import message_factory
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.json_format import ParseDict
+from google.protobuf.json_format import ParseError
 from pyghmi.ipmi import command
 
 import hardware_pb2
 import hardware_pb2_grpc
+import packet_pb2
 import template_pb2
 import template_pb2_grpc
+import tink_complete
 import workflow_pb2
 import workflow_pb2_grpc
 
 ipmi_userid = os.getenv('IPMI_USER')
 ipmi_password = os.getenv('IPMI_PASS')
 
-global all_hardware_info
-global all_template_info
-all_hardware_info = None
-all_template_info = None
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+IDEMPOTENT_METHODS = frozenset([
+    'ByID', 'ByMAC', 'ByIP', 'All', 'GetTemplate', 'ListTemplates', 'GetWorkflow',
+    'ListWorkflows', 'ShowWorkflowEvents', 'GetWorkflowContext',
+    'GetWorkflowContexts', 'GetWorkflowContextList',
+])
+RETRY_CODES = frozenset([
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED,
+])
+DEFAULT_DEADLINE = 30.0
+DEFAULT_DEADLINES = {
+    'All': 300.0,
+    'ListTemplates': 60.0,
+    'ListWorkflows': 300.0,
+    'ShowWorkflowEvents': 60.0,
+    'GetWorkflowContexts': 300.0,
+}
+
+DEFAULT_MAX_IN_FLIGHT = 32
+METHOD_CLASSES = ('read', 'write', 'stream')
+
+# seconds a cached listing is trusted before it is scanned again
+CACHE_TTLS = {
+    'hardware': 300.0,
+    'metadata': 300.0,
+    'templates': 300.0,
+    'workflows': 30.0,
+}
+
+# scans read whole into caches, so concurrent callers can share one buffered copy
+SHARED_STREAMS = frozenset(['All', 'ListTemplates'])
+
+# below this many hardware files starting worker processes costs more than it saves
+PARALLEL_PREPARE_FILES = 64
+
+# failed hooks are retried after 10s, 20s, 40s... up to this many seconds apart
+HOOK_RETRY_DELAY = 10.0
+HOOK_MAX_RETRY_DELAY = 600.0
+
+EXPORT_BATCH_SIZE = 10000
+EXPORT_COLUMNS = {
+    'workflows': ['workflow_id', 'template', 'host', 'mac', 'state', 'created_at'],
+    'events': ['workflow_id', 'template', 'host', 'action_name', 'status',
+               'seconds', 'created_at'],
+}
 
 
 def create_parser():
@@ -39,15 +112,117 @@ def create_parser():
     parser.add_argument("--tink_host",
                         dest="tink_host",
                         default=os.getenv('TINK_HOST'),
-                        help="tink host. required.")
+                        help="tink host, or comma separated list of tink hosts "
+                             "to query in parallel. required.")
+    parser.add_argument("--sites_file",
+                        dest="sites_file",
+                        default=None,
+                        help="yaml file listing tink sites to query in parallel")
     parser.add_argument("--rpc_port",
                         dest="rpc_port",
-                        default="42113",
+                        default=os.getenv('TINK_RPC_PORT', "42113"),
                         help="rpc port. Default is '42113'.")
     parser.add_argument("--http_port",
                         dest="http_port",
                         default="42114",
                         help="http port. Default is '42114'.")
+    parser.add_argument("--offline",
+                        dest="offline",
+                        action='store_true',
+                        default=False,
+                        help="answer get commands from the last saved snapshot "
+                             "without contacting tink")
+    parser.add_argument("--deadlines",
+                        dest="deadlines",
+                        default=os.getenv('TINK_DEADLINES'),
+                        help="per rpc deadlines in seconds, e.g. 'All=600,ByID=5'. "
+                             "'default=N' sets the fallback.")
+    parser.add_argument("--retries",
+                        dest="retries",
+                        type=int,
+                        default=int(os.getenv('TINK_RETRIES', "3")),
+                        help="retries for idempotent reads. Default is 3.")
+    parser.add_argument("--hedge_ms",
+                        dest="hedge_ms",
+                        type=int,
+                        default=int(os.getenv('TINK_HEDGE_MS', "0")),
+                        help="send a second copy of a single-response read if "
+                             "it has not answered within this many ms. "
+                             "Default is 0 (off).")
+    parser.add_argument("--cache_ttl",
+                        dest="cache_ttl",
+                        default=None,
+                        help="comma separated entity=seconds cache lifetimes for "
+                             "hardware, metadata, templates and workflows, e.g. "
+                             "workflows=5")
+    parser.add_argument("--max_in_flight",
+                        dest="max_in_flight",
+                        type=int,
+                        default=int(os.getenv('TINK_MAX_IN_FLIGHT',
+                                              str(DEFAULT_MAX_IN_FLIGHT))),
+                        help="most rpcs in flight to tink at once. Default is "
+                             "'" + str(DEFAULT_MAX_IN_FLIGHT) + "'.")
+    parser.add_argument("--rate",
+                        dest="rate",
+                        type=float,
+                        default=float(os.getenv('TINK_RATE', "0")) or None,
+                        help="most rpcs started per second. Default is unlimited.")
+    parser.add_argument("--limits",
+                        dest="limits",
+                        default=os.getenv('TINK_LIMITS'),
+                        help="per class limits as class=max_in_flight[/rate] for "
+                             "read, write and stream, e.g. 'write=4/10,stream=2'")
+    parser.add_argument("--stats",
+                        dest="stats",
+                        action='store_true',
+                        default=False,
+                        help="print client statistics to stderr when done")
+    parser.add_argument("--record",
+                        dest="record",
+                        default=None,
+                        help="record every rpc request and response to this file")
+    parser.add_argument("--replay",
+                        dest="replay",
+                        default=None,
+                        help="answer rpcs from a file written by --record instead "
+                             "of contacting tink")
+    parser.add_argument("--replay_latency",
+                        dest="replay_latency",
+                        default="zero",
+                        help="replay with 'original' recorded latency or 'zero'. "
+                             "Default is 'zero'.")
+    parser.add_argument("--compression",
+                        dest="compression",
+                        default="none",
+                        help="'gzip' or 'none'. gzip compresses requests, and tink "
+                             "servers with gzip registered answer in kind. Default "
+                             "is 'none'.")
+    parser.add_argument("--keepalive_ms",
+                        dest="keepalive_ms",
+                        type=int,
+                        default=0,
+                        help="ping the server after this many idle ms so long "
+                             "watches survive middleboxes. Servers without a "
+                             "keepalive policy refuse pings under 300000. Default "
+                             "is 0, no pings.")
+    parser.add_argument("--keepalive_timeout_ms",
+                        dest="keepalive_timeout_ms",
+                        type=int,
+                        default=20000,
+                        help="drop the connection if a ping is unanswered this "
+                             "long. Default is 20000.")
+    parser.add_argument("--max_receive_mb",
+                        dest="max_receive_mb",
+                        type=int,
+                        default=0,
+                        help="largest response message in MB. Default is 0, the "
+                             "grpc default of 4.")
+    parser.add_argument("--initial_window",
+                        dest="initial_window",
+                        type=int,
+                        default=0,
+                        help="initial http2 stream window in bytes, raise it for "
+                             "high latency links. Default is 0, the grpc default.")
     parser.add_argument("--template_name",
                         dest="template_name",
                         default=None,
@@ -60,6 +235,10 @@ def create_parser():
                         dest="id",
                         default=None,
                         help="id to operate on")
+    parser.add_argument("--state",
+                        dest="state",
+                        default=None,
+                        help="only show workflows in this state")
     parser.add_argument("--reboot",
                         dest="reboot",
                         action='store_true',
@@ -68,14 +247,87 @@ def create_parser():
     parser.add_argument("--file",
                         dest="file",
                         default=None,
-                        help="file to use for hardware/template")
+                        help="file to use for hardware/template or batch commands. "
+                             "hardware also accepts a directory of json files")
+    parser.add_argument("--listen",
+                        dest="listen",
+                        default="127.0.0.1:8080",
+                        help="address:port serve-http listens on. Default is "
+                             "127.0.0.1:8080.")
+    parser.add_argument("--dir",
+                        dest="dir",
+                        default=None,
+                        help="directory of hardware json and template yaml to sync")
+    parser.add_argument("--dry_run",
+                        dest="dry_run",
+                        action='store_true',
+                        default=False,
+                        help="show the sync plan without applying it")
+    parser.add_argument("--prune",
+                        dest="prune",
+                        action='store_true',
+                        default=False,
+                        help="let sync delete hardware and templates missing from "
+                             "--dir")
+    parser.add_argument("--hosts_file",
+                        dest="hosts_file",
+                        default=None,
+                        help="file with one host name per line to provision")
+    parser.add_argument("--max_running",
+                        dest="max_running",
+                        type=int,
+                        default=5,
+                        help="most workflows provision keeps pending or running "
+                             "at once. Default is 5.")
+    parser.add_argument("--state_file",
+                        dest="state_file",
+                        default=None,
+                        help="where provision keeps its queue, or watch the hooks "
+                             "already run, so they can resume. Default is the hosts "
+                             "or hooks file with .state.json appended.")
+    parser.add_argument("--hooks_file",
+                        dest="hooks_file",
+                        default=None,
+                        help="yaml file of commands and webhooks watch runs on "
+                             "workflow transitions")
+    parser.add_argument("--interval",
+                        dest="interval",
+                        type=float,
+                        default=10.0,
+                        help="seconds between workflow state checks, wait backs "
+                             "off to this while nothing changes. Default is 10.")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        type=int,
+                        default=None,
+                        help="processes used to prepare a directory of hardware "
+                             "files. Default is one per cpu, smaller directories "
+                             "are read serially. sync also applies "
+                             "changes with this many threads, default 8.")
     parser.add_argument("--format",
                         dest="format",
                         default="json",
-                        help="output format (json, yaml)")
+                        help="output format (json, yaml). export supports csv, "
+                             "parquet, arrow")
+    parser.add_argument("--output",
+                        dest="output",
+                        default=None,
+                        help="file to write export to. Default is stdout for csv")
+    parser.add_argument("--since",
+                        dest="since",
+                        default=None,
+                        help="only include events, or exported workflows, "
+                             "at or after this ISO date")
+    parser.add_argument("--until",
+                        dest="until",
+                        default=None,
+                        help="only include events, or exported workflows, "
+                             "at or before this ISO date")
     parser.add_argument("action",
                         help="action to perform")
     parser.add_argument("object",
+                        nargs="?",
+                        default=None,
                         help="what to operate on")
     return parser
 
@@ -95,173 +347,1471 @@ def state_map(r):
         return "Unknown"
 
 
-def get_host_for_mac2(server, port, creds, mac):
-    resp = None
-    try:
-        with grpc.secure_channel(server + ":" + port, creds) as channel:
-            stub = hardware_pb2_grpc.HardwareServiceStub(channel)
-            response = stub.ByMAC(hardware_pb2.GetRequest(mac=mac.lower()))
-            resp = response.network.interfaces[0].dhcp.hostname
-    except grpc._channel._InactiveRpcError:
-        pass
-    return resp
-
-
-def get_host_for_mac(server, port, creds, mac):
-    res = get_all_hardware(server, port, creds)
-    host = ""
-    for re in res:
-        if re['mac'] == mac:
-            host = re['host']
-    return host
-
-
-def get_mac_for_host(server, port, creds, host):
-    res = get_all_hardware(server, port, creds)
-    mac = ""
-    for re in res:
-        if re['host'] == host:
-            mac = re['mac']
-    return mac
-
-
-def get_all_hardware(server, port, creds):
-    global all_hardware_info
-    if all_hardware_info is None:
-        with grpc.secure_channel(server + ":" + port, creds) as channel:
-            stub = hardware_pb2_grpc.HardwareServiceStub(channel)
-            response = stub.All(hardware_pb2.GetRequest())
-            result = []
-
-            for r in response:
-                re = {
-                    'id': r.id,
-                    'host': r.network.interfaces[0].dhcp.hostname,
-                    'ip': r.network.interfaces[0].dhcp.ip.address,
-                    'mac': r.network.interfaces[0].dhcp.mac,
-                }
-                result.append(re)
-        all_hardware_info = result
-    return all_hardware_info
+def parse_cache_ttl(spec):
+    ttls = dict(CACHE_TTLS)
+    if spec:
+        for item in spec.split(","):
+            entity, seconds = item.split("=")
+            if entity.strip() not in ttls:
+                raise ValueError("Cache ttl entity must be one of: "
+                                 + ", ".join(CACHE_TTLS))
+            ttls[entity.strip()] = float(seconds)
+    return ttls
+
+
+def export_timestamp(ts):
+    return datetime.fromtimestamp(ts.seconds, tz=timezone.utc)
+
+
+def iter_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_csv(rows, columns, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for batch in iter_batches(rows, EXPORT_BATCH_SIZE):
+        writer.writerows(batch)
+        count += len(batch)
+    return count
+
+
+def arrow_schema(pa, columns):
+    fields = []
+    for column in columns:
+        if column == 'seconds':
+            fields.append(pa.field(column, pa.int64()))
+        elif column == 'created_at':
+            fields.append(pa.field(column, pa.timestamp('s', tz='UTC')))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
 
 
-def get_hardware(args, creds):
-    if args.id is not None:
-        result = get_hardware_id(args.tink_host, args.rpc_port, creds, args.id)
-    elif args.host is not None:
-        result = get_hardware_name(args.tink_host, args.rpc_port, creds,
-                                   args.host)
+def write_arrow(rows, columns, path, file_format):
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("pyarrow is required for " + file_format + " export")
+    schema = arrow_schema(pa, columns)
+    if file_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
     else:
-        result = get_all_hardware(args.tink_host, args.rpc_port, creds)
+        writer = pyarrow.ipc.new_file(path, schema)
+    count = 0
+    try:
+        for batch in iter_batches(rows, EXPORT_BATCH_SIZE):
+            arrays = [pa.array([row[i] for row in batch], type=field.type)
+                      for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def parse_date(value):
+    if value is None:
+        return None
+    result = datetime.fromisoformat(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=timezone.utc)
     return result
 
 
-def get_hardware_name(server, port, creds, hardware_name):
-    res = get_all_hardware(server, port, creds)
-    result = None
-    for re in res:
-        if re['host'] == hardware_name:
-            result = get_hardware_id(server, port, creds, re['id'])
+def action_statistics(rows):
+    try:
+        import numpy as np
+    except ImportError:
+        raise Exception("numpy is required for analyze")
+    action_codes = {}
+    codes = []
+    seconds = []
+    failed = []
+    for row in rows:
+        if row[5] is None:
+            continue
+        codes.append(action_codes.setdefault(row[3], len(action_codes)))
+        seconds.append(row[5])
+        failed.append(row[4] in ("Failed", "Timeout"))
+    if not codes:
+        return []
+
+    codes = np.array(codes, dtype=np.int64)
+    seconds = np.array(seconds, dtype=np.float64)
+    failed = np.array(failed, dtype=np.float64)
+    nactions = len(action_codes)
+    counts = np.bincount(codes, minlength=nactions)
+    totals = np.bincount(codes, weights=seconds, minlength=nactions)
+    failures = np.bincount(codes, weights=failed, minlength=nactions)
+
+    # sort durations within each action so percentiles are index lookups
+    order = np.lexsort((seconds, codes))
+    ordered = seconds[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    maxima = ordered[starts + counts - 1]
+    percentiles = {}
+    for q in (50, 90, 99):
+        pos = starts + (counts - 1) * (q / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        percentiles[q] = ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+    names = sorted(action_codes, key=action_codes.get)
+    result = []
+    for code in np.argsort(-totals, kind='stable'):
+        result.append({
+            'action_name': names[code],
+            'count': int(counts[code]),
+            'p50': round(float(percentiles[50][code]), 2),
+            'p90': round(float(percentiles[90][code]), 2),
+            'p99': round(float(percentiles[99][code]), 2),
+            'max': int(maxima[code]),
+            'failure_rate': round(float(failures[code] / counts[code]), 4),
+            'total_seconds': int(totals[code]),
+        })
     return result
 
 
-def get_hardware_id(server, port, creds, hardware_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = hardware_pb2_grpc.HardwareServiceStub(channel)
-        response = stub.ByID(hardware_pb2.GetRequest(id=hardware_id))
-        result = {
-            'id': response.id,
-            'host': response.network.interfaces[0].dhcp.hostname,
-            'ip': response.network.interfaces[0].dhcp.ip.address,
-            'mac': response.network.interfaces[0].dhcp.mac,
-        }
-    return result
+def valid_mac(mac):
+    octets = mac.split(":")
+    return len(octets) == 6 and all(len(octet) == 2 and HEX_DIGITS.issuperset(octet)
+                                    for octet in octets)
+
+
+def metadata_errors(value, message, path="metadata"):
+    if not isinstance(value, dict):
+        return [path + ": expected an object"]
+    descriptor = message.DESCRIPTOR
+    json_fields = {field.json_name: field for field in descriptor.fields}
+    errors = []
+    for key, item in value.items():
+        field = descriptor.fields_by_name.get(key, json_fields.get(key))
+        field_path = path + "." + key
+        if field is None:
+            errors.append(field_path + ": unknown field")
+        elif field.message_type is None:
+            try:
+                ParseDict({key: item}, type(message)())
+            except ParseError as e:
+                errors.append(field_path + ": " + str(e))
+        elif field.label != field.LABEL_REPEATED:
+            errors.extend(metadata_errors(item, getattr(message, field.name),
+                                          field_path))
+        elif not isinstance(item, list):
+            errors.append(field_path + ": expected a list")
+        else:
+            for index, sub_item in enumerate(item):
+                errors.extend(metadata_errors(sub_item,
+                                              getattr(message, field.name).add(),
+                                              field_path + "[" + str(index) + "]"))
+    return errors
+
+
+def validate_hardware(hardware):
+    if not isinstance(hardware, dict):
+        return ["Expected an object"]
+    errors = []
+    network = hardware.get('network', {})
+    interfaces = network.get('interfaces', []) if isinstance(network, dict) else []
+    if not isinstance(interfaces, list) or len(interfaces) != 1:
+        errors.append("Must specify exactly one IP per host")
+    if 'id' not in hardware:
+        errors.append("Missing id")
+    elif not isinstance(hardware['id'], str):
+        errors.append("Id must be a string")
+    elif hardware['id'] != hardware['id'].lower():
+        errors.append("Uppercase in Id")
+    if 'metadata' not in hardware:
+        errors.append("Missing metadata")
+    else:
+        errors.extend(metadata_errors(hardware['metadata'], packet_pb2.Metadata()))
+    if not isinstance(interfaces, list) or len(interfaces) == 0:
+        return errors
+    dhcp = interfaces[0].get('dhcp', {}) if isinstance(interfaces[0], dict) else None
+    if not isinstance(dhcp, dict):
+        errors.append("Invalid dhcp")
+        return errors
+    hostname = dhcp.get('hostname', "")
+    if not isinstance(hostname, str) or hostname == "":
+        errors.append("Missing hostname")
+    mac = dhcp.get('mac', "")
+    if not isinstance(mac, str) or not valid_mac(mac):
+        errors.append("Invalid MAC address")
+    elif mac != mac.lower():
+        errors.append("Uppercase in MAC")
+    ip = dhcp.get('ip', {})
+    try:
+        if not isinstance(ip, dict) or not isinstance(ip.get('address', ""), str):
+            raise ValueError
+        ipaddress.ip_address(ip.get('address', ""))
+    except ValueError:
+        errors.append("Invalid IP")
+    return errors
 
 
-def get_all_templates(server, port, creds):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = template_pb2_grpc.TemplateServiceStub(channel)
-        response = stub.ListTemplates(template_pb2.GetRequest())
-        result = []
-        for r in response:
-            re = {
-                'name': r.name,
-                'id': r.id,
-            }
-            result.append(re)
-    return result
+def hardware_keys(hardware):
+    dhcp = hardware['network']['interfaces'][0]['dhcp']
+    return {
+        'id': hardware['id'],
+        'host': dhcp['hostname'].lower(),
+        'ip': dhcp['ip']['address'],
+        'mac': dhcp['mac'].lower(),
+    }
 
 
-def get_template_by_id(server, port, creds, template_id):
-    global all_template_info
-    if all_template_info is None:
-        all_template_info = get_all_templates(server, port, creds)
-    result = {}
-    for re in all_template_info:
-        if re['id'] == template_id:
-            result = re
-    return result
+def build_hardware(hardware):
+    data = dict(hardware)
+    metadata = data.pop('metadata')
+    hardware_wrapper = ParseDict(data, hardware_pb2.Hardware())
+    hardware_wrapper.metadata = json.dumps(metadata, separators=(',', ':'))
+    return hardware_wrapper
 
 
-def get_template_by_name(server, port, creds, template_name):
-    res = get_all_templates(server, port, creds)
-    result = None
-    for re in res:
-        if re['name'] == template_name:
-            result = re['id']
+def prepare_hardware(hardware_file):
+    try:
+        with open(hardware_file) as my_file:
+            records = json.load(my_file)
+    except (OSError, ValueError) as e:
+        return [{'file': hardware_file, 'errors': [str(e)]}]
+    if isinstance(records, dict):
+        records = [records]
+    elif not isinstance(records, list):
+        return [{'file': hardware_file,
+                 'errors': ["Expected an object or a list of objects"]}]
+    result = []
+    for hardware in records:
+        re = {'file': hardware_file, 'errors': validate_hardware(hardware)}
+        if not re['errors']:
+            try:
+                re['data'] = build_hardware(hardware).SerializeToString()
+                re['keys'] = hardware_keys(hardware)
+            except ParseError as e:
+                re['errors'].append(str(e))
+        result.append(re)
     return result
 
 
-def get_template_steps(server, port, creds, template_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = template_pb2_grpc.TemplateServiceStub(channel)
-        response = stub.GetTemplate(template_pb2.GetRequest(id=template_id))
-    return response.data
+def hardware_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.endswith(".json"))
 
 
-def get_template_steps_by_name(args, creds, raw_result):
-    temp_result = get_all_templates(args.tink_host, args.rpc_port, creds)
-    for template in temp_result:
-        if template['name'] == args.template_name:
-            template_id = template['id']
-            raw_result = get_template_steps(args.tink_host,
-                                            args.rpc_port, creds,
-                                            template_id=template_id)
-    return raw_result
+def prepare_hardware_files(paths, workers=None):
+    if len(paths) >= PARALLEL_PREPARE_FILES and workers != 1:
+        # spawn rather than fork, forking a process with live grpc threads
+        # is not safe
+        context = multiprocessing.get_context("spawn")
+        with futures.ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=context) as executor:
+            prepared = executor.map(prepare_hardware, paths, chunksize=64)
+            return [re for result in prepared for re in result]
+    return [re for path in paths for re in prepare_hardware(path)]
 
 
-def get_all_workflows(server, port, creds):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
-        response = stub.ListWorkflows(workflow_pb2.GetRequest())
-        result = []
-        for r in response:
-            re = {
-                'id': r.id,
+def desired_files(directory):
+    hardware = []
+    templates = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(names):
+            if name.endswith(".json"):
+                hardware.append(os.path.join(root, name))
+            elif name.endswith((".yaml", ".yml")):
+                templates.append(os.path.join(root, name))
+    return hardware, templates
+
+
+class Record:
+    """Slotted result record, read like a dict and turned into one for output."""
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return type(self).__name__ + repr(self.to_dict())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        return {name: as_dict(getattr(self, name)) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class HardwareRecord(Record):
+    __slots__ = ('id', 'host', 'ip', 'mac')
+
+
+class TemplateRecord(Record):
+    __slots__ = ('name', 'id')
+
+
+class DeviceRecord(Record):
+    __slots__ = ('host', 'mac')
+
+
+class WorkflowRecord(Record):
+    __slots__ = ('id', 'template', 'state', 'devices')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'template': self.template.to_dict() if self.template is not None else {},
+            'state': self.state,
+            'devices': [device.to_dict() for device in self.devices],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        template = data['template']
+        return cls(data['id'],
+                   TemplateRecord.from_dict(template) if template else None,
+                   data['state'],
+                   tuple(DeviceRecord.from_dict(device) for device in data['devices']))
+
+
+class EventRecord(Record):
+    __slots__ = ('action_name', 'action_status', 'message', 'timestamp', 'seconds')
+
+    def keys(self):
+        # seconds is only reported once an action has finished
+        if self.seconds is None:
+            return self.__slots__[:-1]
+        return self.__slots__
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.keys()}
+
+
+SNAPSHOT_RECORDS = {
+    'hardware': HardwareRecord,
+    'templates': TemplateRecord,
+    'workflows': WorkflowRecord,
+}
+
+
+def as_dict(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [as_dict(item) for item in value]
+    if isinstance(value, dict):
+        return {key: as_dict(item) for key, item in value.items()}
+    return value
+
+
+def lean_message(message_class, fields):
+    """Build a message type that decodes only the named fields and skips the rest.
+
+    fields maps field names to None, or to the fields wanted from a nested
+    message. Field numbers and wire types are copied from message_class so the
+    lean type parses the same bytes.
+    """
+    package = "lean." + message_class.DESCRIPTOR.full_name
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name=package.replace(".", "/") + ".proto", package=package, syntax="proto3")
+
+    def add(descriptor, wanted):
+        message = file_proto.message_type.add(
+            name=descriptor.full_name.replace(".", "_"))
+        for name, nested in wanted.items():
+            field = descriptor.fields_by_name[name]
+            field_proto = message.field.add(name=field.name, number=field.number,
+                                            type=field.type, label=field.label)
+            if field.type == field.TYPE_ENUM:
+                field_proto.type = field.TYPE_INT32
+            elif nested is not None:
+                field_proto.type_name = "." + package + "." + add(
+                    field.message_type, nested)
+        return message.name
+
+    name = add(message_class.DESCRIPTOR, fields)
+    pool = descriptor_pool.DescriptorPool()
+    pool.AddSerializedFile(file_proto.SerializeToString())
+    factory = message_factory.MessageFactory(pool)
+    return factory.GetPrototype(pool.FindMessageTypeByName(package + "." + name))
+
+
+LeanHardware = lean_message(hardware_pb2.Hardware, {
+    'id': None,
+    'network': {'interfaces': {'dhcp': {
+        'mac': None, 'hostname': None, 'ip': {'address': None}}}},
+})
+
+
+def hardware_summary(r):
+    dhcp = r.network.interfaces[0].dhcp
+    return HardwareRecord(r.id, dhcp.hostname, dhcp.ip.address, dhcp.mac)
+
+
+def hardware_digest(hardware):
+    data = MessageToDict(hardware, preserving_proto_field_name=True)
+    if data.get('metadata'):
+        data['metadata'] = json.loads(data['metadata'])
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def template_digest(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def check_duplicates(records, existing):
+    seen = {
+        'id': {re['id'] for re in existing},
+        'host': {re['host'].lower() for re in existing},
+        'ip': {re['ip'] for re in existing},
+        'mac': {re['mac'].lower() for re in existing},
+    }
+    messages = {
+        'id': "Duplicate hardware ID",
+        'host': "Duplicate hostname",
+        'ip': "Duplicate IP",
+        'mac': "Duplicate MAC address",
+    }
+    for record in records:
+        if record['errors']:
+            continue
+        for key, value in record['keys'].items():
+            if value in seen[key]:
+                record['errors'].append(messages[key])
+            seen[key].add(value)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class Limit:
+    def __init__(self, max_in_flight=None, rate=None):
+        self.slots = None
+        self.bucket = None
+        if max_in_flight:
+            self.slots = threading.BoundedSemaphore(max_in_flight)
+        if rate:
+            self.bucket = TokenBucket(rate)
+
+    def acquire(self, nested):
+        if self.bucket is not None:
+            self.bucket.acquire()
+        if self.slots is not None and not nested:
+            self.slots.acquire()
+
+    def release(self, nested):
+        if self.slots is not None and not nested:
+            self.slots.release()
+
+
+class Governor:
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self.lock = threading.Lock()
+        self.held = threading.local()
+        self.metrics = {}
+        for method_class in ('read', 'write', 'stream'):
+            self.metrics[method_class] = {
+                'calls': 0,
+                'queued': 0,
+                'wait_seconds': 0.0,
+                'max_wait_seconds': 0.0,
+                'in_flight': 0,
+                'peak_in_flight': 0,
             }
-            template = get_template_by_id(server, port, creds, template_id=r.template)
-            re['template'] = template
-            re['state'] = state_map(r.state)
-            hardware_json = json.loads(r.hardware)
-            devs = []
-            for dev in hardware_json.keys():
-                mac = hardware_json[dev]
-                host = get_host_for_mac(server, port, creds, mac)
-                dev_data = {
-                    'host': host,
-                    'mac': mac,
-                }
-                devs.append(dev_data)
-            re['devices'] = devs
-
-            result.append(re)
-    return result
 
+    @classmethod
+    def from_spec(cls, spec, max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate=None):
+        limits = {'global': Limit(max_in_flight=max_in_flight, rate=rate)}
+        if spec:
+            for item in spec.split(","):
+                method_class, value = item.split("=")
+                if method_class.strip() not in METHOD_CLASSES:
+                    raise ValueError("Limit class must be one of: "
+                                     + ", ".join(METHOD_CLASSES))
+                slots, _, class_rate = value.partition("/")
+                limits[method_class.strip()] = Limit(
+                    max_in_flight=int(slots) if slots else None,
+                    rate=float(class_rate) if class_rate else None)
+        return cls(limits)
+
+    @contextlib.contextmanager
+    def slot(self, method_class):
+        # a thread already holding a slot (e.g. iterating a stream while making
+        # lookups) is not made to wait for a second one, that could deadlock
+        nested = getattr(self.held, 'depth', 0) > 0
+        limits = [limit for limit in (self.limits.get(method_class),
+                                      self.limits.get('global'))
+                  if limit is not None]
+        start = time.monotonic()
+        acquired = []
+        try:
+            for limit in limits:
+                limit.acquire(nested)
+                acquired.append(limit)
+            wait = time.monotonic() - start
+            with self.lock:
+                metrics = self.metrics[method_class]
+                metrics['calls'] += 1
+                if wait > 0.001:
+                    metrics['queued'] += 1
+                metrics['wait_seconds'] += wait
+                metrics['max_wait_seconds'] = max(metrics['max_wait_seconds'], wait)
+                metrics['in_flight'] += 1
+                metrics['peak_in_flight'] = max(metrics['peak_in_flight'],
+                                                metrics['in_flight'])
+            self.held.depth = getattr(self.held, 'depth', 0) + 1
+            try:
+                yield
+            finally:
+                self.held.depth -= 1
+                with self.lock:
+                    metrics['in_flight'] -= 1
+        finally:
+            for limit in acquired:
+                limit.release(nested)
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for method_class, metrics in self.metrics.items():
+                result[method_class] = dict(metrics)
+                result[method_class]['wait_seconds'] = round(metrics['wait_seconds'],
+                                                             3)
+                result[method_class]['max_wait_seconds'] = round(
+                    metrics['max_wait_seconds'], 3)
+            return result
+
+
+class Singleflight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.metrics = collections.defaultdict(lambda: {'calls': 0, 'shared': 0})
+
+    def do(self, method, key, fn):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = futures.Future()
+                self.flights[key] = flight
+                self.metrics[method]['calls'] += 1
+            else:
+                self.metrics[method]['shared'] += 1
+        if leader:
+            try:
+                flight.set_result(fn())
+            except Exception as e:
+                flight.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.flights[key]
+        return flight.result()
+
+    def stats(self):
+        with self.lock:
+            return {method: dict(metrics) for method, metrics in self.metrics.items()}
+
+
+class CallPolicy:
+    def __init__(self, deadlines=None, retries=3, hedge_delay=None,
+                 backoff=0.1, max_backoff=5.0, governor=None):
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.retries = retries
+        self.hedge_delay = hedge_delay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.governor = governor if governor is not None else Governor()
+        self.flights = Singleflight()
+
+    @classmethod
+    def from_args(cls, args):
+        deadlines = {}
+        if args.deadlines:
+            for item in args.deadlines.split(","):
+                method, seconds = item.split("=")
+                deadlines[method.strip()] = float(seconds)
+        hedge_delay = args.hedge_ms / 1000.0 if args.hedge_ms > 0 else None
+        governor = Governor.from_spec(args.limits, max_in_flight=args.max_in_flight,
+                                      rate=args.rate)
+        return cls(deadlines=deadlines, retries=args.retries, hedge_delay=hedge_delay,
+                   governor=governor)
+
+    def deadline(self, method):
+        default = self.deadlines.get('default', DEFAULT_DEADLINE)
+        return self.deadlines.get(method, default)
+
+    def should_retry(self, method, error, attempt):
+        return method in IDEMPOTENT_METHODS and attempt < self.retries and \
+            error.code() in RETRY_CODES
+
+    def sleep(self, attempt):
+        # full jitter keeps many clients retrying at once from synchronising
+        time.sleep(random.uniform(0, min(self.max_backoff,
+                                         self.backoff * 2 ** attempt)))
+
+    def call(self, method, multicallable, request):
+        # identical reads already in flight on this channel share their result
+        key = (multicallable, request.SerializeToString())
+        if isinstance(multicallable, grpc.UnaryStreamMultiCallable):
+            if method in SHARED_STREAMS:
+                return iter(self.flights.do(method, key, lambda: list(
+                    self.call_stream(method, multicallable, request))))
+            return self.call_stream(method, multicallable, request)
+        if method in IDEMPOTENT_METHODS:
+            return self.flights.do(method, key, functools.partial(
+                self.call_unary, method, multicallable, request))
+        return self.call_unary(method, multicallable, request)
+
+    def call_unary(self, method, multicallable, request):
+        method_class = 'read' if method in IDEMPOTENT_METHODS else 'write'
+        attempt = 0
+        while True:
+            try:
+                with self.governor.slot(method_class):
+                    if self.hedge_delay is not None and method_class == 'read':
+                        return self.call_hedged(method, multicallable, request)
+                    return multicallable(request, timeout=self.deadline(method))
+            except grpc.RpcError as e:
+                if not self.should_retry(method, e, attempt):
+                    raise
+            self.sleep(attempt)
+            attempt += 1
+
+    def call_stream(self, method, multicallable, request):
+        attempt = 0
+        while True:
+            started = False
+            try:
+                with self.governor.slot('stream'):
+                    for response in multicallable(request,
+                                                  timeout=self.deadline(method)):
+                        started = True
+                        yield response
+                return
+            except grpc.RpcError as e:
+                # once records have been handed out a retry would repeat them
+                if started or not self.should_retry(method, e, attempt):
+                    raise
+            self.sleep(attempt)
+            attempt += 1
+
+    def call_hedged(self, method, multicallable, request):
+        done = queue.Queue()
+        calls = [multicallable.future(request, timeout=self.deadline(method))]
+        calls[0].add_done_callback(done.put)
+        try:
+            first = done.get(timeout=self.hedge_delay)
+        except queue.Empty:
+            calls.append(multicallable.future(request,
+                                              timeout=self.deadline(method)))
+            calls[1].add_done_callback(done.put)
+            first = done.get()
+        try:
+            if first.exception() is None or len(calls) == 1:
+                return first.result()
+            return done.get().result()
+        finally:
+            for call in calls:
+                call.cancel()
+
+
+class ChannelSettings:
+    COMPRESSION = {
+        'none': grpc.Compression.NoCompression,
+        'gzip': grpc.Compression.Gzip,
+    }
+
+    def __init__(self, compression="none", keepalive_ms=0, keepalive_timeout_ms=20000,
+                 max_receive_mb=0, initial_window=0):
+        if compression not in self.COMPRESSION:
+            raise ValueError("Compression must be one of: "
+                             + ", ".join(self.COMPRESSION))
+        self.compression = compression
+        self.keepalive_ms = keepalive_ms
+        self.keepalive_timeout_ms = keepalive_timeout_ms
+        self.max_receive_mb = max_receive_mb
+        self.initial_window = initial_window
+
+    @classmethod
+    def from_args(cls, args, overrides=None):
+        settings = {name: getattr(args, name) for name in (
+            'compression', 'keepalive_ms', 'keepalive_timeout_ms', 'max_receive_mb',
+            'initial_window')}
+        settings.update(overrides or {})
+        return cls(**settings)
+
+    def options(self):
+        options = []
+        if self.keepalive_ms > 0:
+            options.extend([
+                ('grpc.keepalive_time_ms', self.keepalive_ms),
+                ('grpc.keepalive_timeout_ms', self.keepalive_timeout_ms),
+                # keep pinging through long quiet watch streams
+                ('grpc.http2.max_pings_without_data', 0),
+            ])
+        if self.max_receive_mb > 0:
+            options.append(('grpc.max_receive_message_length',
+                            self.max_receive_mb * 1024 * 1024))
+        if self.initial_window > 0:
+            options.append(('grpc.http2.lookahead_bytes', self.initial_window))
+        return options
+
+    def open(self, addresses, port, creds):
+        options = self.options()
+        targets = [address_target(address, port) for address in addresses]
+        if len(targets) == 1:
+            target = targets[0]
+        else:
+            # spread calls over every replica, skipping ones that fail health checks
+            scheme = "ipv6:" if ":" in addresses[0] else "ipv4:"
+            target = scheme + ",".join(targets)
+            options.extend([
+                ('grpc.default_authority', targets[0]),
+                ('grpc.service_config', json.dumps({
+                    'loadBalancingConfig': [{'round_robin': {}}],
+                    'healthCheckConfig': {'serviceName': ""},
+                })),
+            ])
+        return grpc.secure_channel(target, creds, options=options,
+                                   compression=self.COMPRESSION[self.compression])
+
+
+def address_target(address, port):
+    if ":" in address:
+        return "[" + address + "]:" + port
+    return address + ":" + port
+
+
+def resolve_addresses(hosts, port):
+    addresses = {socket.AF_INET: [], socket.AF_INET6: []}
+    for host in hosts:
+        for family, _, _, _, sockaddr in socket.getaddrinfo(
+                host, port, type=socket.SOCK_STREAM):
+            if family in addresses and sockaddr[0] not in addresses[family]:
+                addresses[family].append(sockaddr[0])
+    # a channel balances over one address family, prefer ipv4 as before
+    return addresses[socket.AF_INET] or addresses[socket.AF_INET6]
+
+
+class PolicyStub:
+    def __init__(self, stub, policy):
+        self.stub = stub
+        self.policy = policy
+
+    def __getattr__(self, method):
+        return functools.partial(self.policy.call, method,
+                                 getattr(self.stub, method))
+
+
+class ScanStub:
+    """Stub for the listing calls that decodes responses into lean messages."""
+
+    def __init__(self, channel):
+        service = hardware_pb2.DESCRIPTOR.services_by_name['HardwareService']
+        self.All = channel.unary_stream(
+            '/' + service.full_name + '/All',
+            request_serializer=hardware_pb2.GetRequest.SerializeToString,
+            response_deserializer=LeanHardware.FromString)
+
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(data):
+    return base64.b64decode(data)
+
+
+class RecordingInterceptor(grpc.UnaryUnaryClientInterceptor,
+                           grpc.UnaryStreamClientInterceptor):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.out = gzip.open(path, 'wt')
+
+    def close(self):
+        with self.lock:
+            self.out.close()
+
+    def write(self, method, request, responses, error, elapsed):
+        record = {
+            'method': method,
+            'request': encode_bytes(request.SerializeToString()),
+            'responses': [[round(offset, 6), encode_bytes(response)]
+                          for offset, response in responses],
+            'error': [error.code().name, error.details()] if error else None,
+            'elapsed': round(elapsed, 6),
+        }
+        with self.lock:
+            self.out.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        start = time.time()
+        call = continuation(client_call_details, request)
+
+        def record(done):
+            elapsed = time.time() - start
+            error = done.exception()
+            responses = []
+            if error is None:
+                responses.append([elapsed, done.result().SerializeToString()])
+            elif not isinstance(error, grpc.RpcError):
+                return
+            self.write(client_call_details.method, request, responses, error,
+                       elapsed)
+        call.add_done_callback(record)
+        return call
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        start = time.time()
+        call = continuation(client_call_details, request)
+        return self.recorded_stream(client_call_details.method, request, call,
+                                    start)
+
+    def recorded_stream(self, method, request, call, start):
+        responses = []
+        error = None
+        try:
+            for response in call:
+                responses.append([time.time() - start, response.SerializeToString()])
+                yield response
+        except grpc.RpcError as e:
+            error = e
+            raise
+        finally:
+            self.write(method, request, responses, error, time.time() - start)
+
+
+class ReplayError(grpc.RpcError):
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.status_code = code
+        self.status_details = details
+
+    def code(self):
+        return self.status_code
+
+    def details(self):
+        return self.status_details
+
+
+class ReplayUnaryUnary(grpc.UnaryUnaryMultiCallable):
+    def __init__(self, channel, method, request_serializer, response_deserializer):
+        self.channel = channel
+        self.method = method
+        self.request_serializer = request_serializer
+        self.response_deserializer = response_deserializer
+
+    def __call__(self, request, timeout=None, metadata=None, credentials=None,
+                 wait_for_ready=None, compression=None):
+        record = self.channel.lookup(self.method, self.request_serializer(request))
+        self.channel.wait(record['elapsed'])
+        self.channel.raise_error(record)
+        return self.response_deserializer(decode_bytes(record['responses'][0][1]))
+
+    def with_call(self, request, timeout=None, metadata=None, credentials=None,
+                  wait_for_ready=None, compression=None):
+        return self(request, timeout=timeout), None
+
+    def future(self, request, timeout=None, metadata=None, credentials=None,
+               wait_for_ready=None, compression=None):
+        return self.channel.executor().submit(self, request, timeout=timeout)
+
+
+class ReplayUnaryStream(grpc.UnaryStreamMultiCallable):
+    def __init__(self, channel, method, request_serializer, response_deserializer):
+        self.channel = channel
+        self.method = method
+        self.request_serializer = request_serializer
+        self.response_deserializer = response_deserializer
+
+    def __call__(self, request, timeout=None, metadata=None, credentials=None,
+                 wait_for_ready=None, compression=None):
+        record = self.channel.lookup(self.method, self.request_serializer(request))
+        return self.replay(record)
+
+    def replay(self, record):
+        start = time.time()
+        for offset, response in record['responses']:
+            self.channel.wait(offset - (time.time() - start))
+            yield self.response_deserializer(decode_bytes(response))
+        self.channel.raise_error(record)
+
+
+class ReplayChannel(grpc.Channel):
+    def __init__(self, path, latency="zero"):
+        self.latency = latency
+        self.records = collections.defaultdict(collections.deque)
+        self.pool = None
+        with gzip.open(path, 'rt') as my_file:
+            for line in my_file:
+                record = json.loads(line)
+                key = (record['method'], decode_bytes(record['request']))
+                self.records[key].append(record)
+
+    def lookup(self, method, request):
+        recorded = self.records.get((method, request))
+        if not recorded:
+            raise ReplayError(grpc.StatusCode.NOT_FOUND,
+                              "No recorded response for " + method)
+        # identical requests replay in recorded order, the last one repeats
+        if len(recorded) > 1:
+            return recorded.popleft()
+        return recorded[0]
+
+    def wait(self, seconds):
+        if self.latency == "original" and seconds > 0:
+            time.sleep(seconds)
+
+    def raise_error(self, record):
+        if record['error'] is not None:
+            raise ReplayError(grpc.StatusCode[record['error'][0]],
+                              record['error'][1])
+
+    def executor(self):
+        if self.pool is None:
+            self.pool = futures.ThreadPoolExecutor(max_workers=8)
+        return self.pool
+
+    def unary_unary(self, method, request_serializer=None,
+                    response_deserializer=None, **kwargs):
+        return ReplayUnaryUnary(self, method, request_serializer,
+                                response_deserializer)
+
+    def unary_stream(self, method, request_serializer=None,
+                     response_deserializer=None, **kwargs):
+        return ReplayUnaryStream(self, method, request_serializer,
+                                 response_deserializer)
+
+    def stream_unary(self, method, request_serializer=None,
+                     response_deserializer=None, **kwargs):
+        raise NotImplementedError("Replay does not support client streaming")
+
+    def stream_stream(self, method, request_serializer=None,
+                      response_deserializer=None, **kwargs):
+        raise NotImplementedError("Replay does not support client streaming")
+
+    def subscribe(self, callback, try_to_connect=False):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def snapshot_path(name, port):
+    return os.path.join(tink_complete.SNAPSHOT_DIR, name + "_" + port + ".json")
+
+
+def write_indexes(name, port, snapshot):
+    def records(section):
+        return snapshot.get(section, {}).get('records', [])
+    entries = {
+        'host': [re['host'] for re in records('hardware')],
+        'template': [re['name'] for re in records('templates')],
+        'id': [re['id'] for section in ('hardware', 'templates', 'workflows')
+               for re in records(section)],
+    }
+    for kind, values in entries.items():
+        try:
+            tink_complete.write_index(tink_complete.index_path(name, port, kind),
+                                      values)
+        except OSError as e:
+            logging.debug("Could not save %s index: %s", kind, e)
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as my_file:
+            return json.load(my_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as my_file:
+        json.dump(data, my_file)
+    os.replace(my_file.name, path)
+
+
+def write_snapshot(path, snapshot):
+    # records are converted a batch at a time, a dict copy of a whole scan
+    # would briefly hold every record twice
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as my_file:
+            my_file.write("{")
+            for number, (section, data) in enumerate(snapshot.items()):
+                my_file.write("%s%s: {\"updated\": %s, \"records\": "
+                              % ("," if number else "", json.dumps(section),
+                                 json.dumps(data['updated'])))
+                records = data['records']
+                if isinstance(records, dict):
+                    json.dump(as_dict(records), my_file)
+                else:
+                    my_file.write("[")
+                    for count, batch in enumerate(iter_batches(records, 1000)):
+                        my_file.write(("," if count else "")
+                                      + json.dumps(as_dict(batch))[1:-1])
+                    my_file.write("]")
+                my_file.write("}")
+            my_file.write("}")
+        os.replace(my_file.name, path)
+    except OSError as e:
+        logging.debug("Could not save snapshot %s: %s", path, e)
+
+
+class TinkClient:
+    def __init__(self, server, port, creds, name=None, policy=None, channel=None,
+                 interceptors=(), settings=None, replicas=(), cache_ttl=None,
+                 snapshots=True):
+        self.server = server
+        self.replicas = list(replicas)
+        self.port = port
+        self.creds = creds
+        self.name = name if name is not None else server
+        self.policy = policy if policy is not None else CallPolicy()
+        # embedded clients can turn off the offline snapshot and its indexes
+        self.snapshot_file = snapshot_path(self.name, port) if snapshots else None
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_changes = []
+        self.snapshot_writer = futures.ThreadPoolExecutor(max_workers=1)
+        if channel is None:
+            if settings is None:
+                settings = ChannelSettings()
+            channel = settings.open([server] + self.replicas, port, creds)
+        self.interceptors = list(interceptors)
+        if self.interceptors:
+            channel = grpc.intercept_channel(channel, *self.interceptors)
+        self.channel = channel
+        self.hardware_stub = PolicyStub(
+            hardware_pb2_grpc.HardwareServiceStub(self.channel), self.policy)
+        self.template_stub = PolicyStub(
+            template_pb2_grpc.TemplateServiceStub(self.channel), self.policy)
+        self.workflow_stub = PolicyStub(
+            workflow_pb2_grpc.WorkflowServiceStub(self.channel), self.policy)
+        self.scan_stub = PolicyStub(ScanStub(self.channel), self.policy)
+        self.cache_ttl = cache_ttl if cache_ttl is not None else dict(CACHE_TTLS)
+        self.refills = Singleflight()
+        self.invalidate()
+
+    @classmethod
+    def connect(cls, tink_host, rpc_port="42113", http_port="42114", policy=None,
+                interceptors=(), settings=None, replicas=(), cache_ttl=None,
+                snapshots=True):
+        addresses = resolve_addresses([tink_host] + list(replicas), rpc_port)
+        if not addresses:
+            raise OSError("No addresses found for " + tink_host)
+        timeout = policy.deadline('cert') if policy is not None else DEFAULT_DEADLINE
+        for server in addresses:
+            cert_url = 'http://' + address_target(server, http_port) + '/cert'
+            try:
+                with urllib.request.urlopen(cert_url, timeout=timeout) as response:
+                    trusted_certs = response.read()
+                break
+            except OSError:
+                # another replica can hand out the certificate
+                if server == addresses[-1]:
+                    raise
+        creds = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
+        return cls(addresses[0], rpc_port, creds, name=tink_host, policy=policy,
+                   interceptors=interceptors, settings=settings,
+                   replicas=addresses[1:], cache_ttl=cache_ttl,
+                   snapshots=snapshots)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # pending snapshot writes finish before the client goes away
+        self.snapshot_writer.shutdown(wait=True)
+        self.channel.close()
+        for interceptor in self.interceptors:
+            interceptor.close()
+
+    def load_snapshot(self):
+        if self.snapshot is None:
+            self.snapshot = read_snapshot(self.snapshot_file)
+        return self.snapshot
+
+    def change_snapshot(self, change):
+        # scans only queue their records, the writer thread merges and saves
+        # them so no request waits on converting and writing the snapshot
+        if self.snapshot_file is None:
+            return
+        with self.snapshot_lock:
+            self.snapshot_changes.append(change)
+        try:
+            self.snapshot_writer.submit(self.save_snapshot)
+        except RuntimeError:
+            # closed, nothing more is saved
+            pass
+
+    def save_snapshot(self):
+        with self.snapshot_lock:
+            changes, self.snapshot_changes = self.snapshot_changes, []
+        if not changes:
+            return
+        snapshot = self.load_snapshot()
+        for change in changes:
+            change(snapshot)
+        write_snapshot(self.snapshot_file, snapshot)
+        write_indexes(self.name, self.port, snapshot)
+
+    def flush_snapshot(self):
+        # the writer runs one task at a time, so this waits for all before it
+        if self.snapshot_file is not None:
+            self.snapshot_writer.submit(self.save_snapshot).result()
+
+    def update_snapshot(self, section, records):
+        # a shallow copy, the caches keep changing the lists they hold
+        section_data = {'updated': time.time(), 'records': records.copy()}
+        self.change_snapshot(lambda snapshot: snapshot.update({section: section_data}))
+
+    def drop_snapshot_records(self, section, record_ids):
+        record_ids = set(record_ids)
+        if not record_ids:
+            return
+
+        def drop(snapshot):
+            # deletes leave the rest of the snapshot as old as it was, so only
+            # the records go and the section keeps its timestamp
+            if section not in snapshot:
+                return
+            records = snapshot[section]['records']
+            if isinstance(records, dict):
+                kept = {key: re for key, re in records.items()
+                        if key not in record_ids}
+            else:
+                kept = [re for re in records if re['id'] not in record_ids]
+            snapshot[section] = dict(snapshot[section], records=kept)
+        self.change_snapshot(drop)
+
+    def refresh_indexes(self):
+        self.invalidate()
+        self.get_all_hardware()
+        self.get_all_templates()
+        self.get_all_workflows()
+        self.flush_snapshot()
+        return True
+
+    def stats(self):
+        return {
+            'governor': self.policy.governor.stats(),
+            'singleflight': self.policy.flights.stats(),
+        }
 
-def get_workflow_events(server, port, creds, workflow_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
-        res = stub.ShowWorkflowEvents(workflow_pb2.GetRequest(id=workflow_id))
+    def invalidate_hardware(self):
+        self.hardware_info = None
+        self.hardware_by_id = None
+        self.hardware_by_mac = None
+        self.hardware_by_host = None
+        self.hardware_loaded = None
+        self.hardware_metadata = {}
+
+    def invalidate_templates(self):
+        self.template_info = None
+        self.template_by_id = None
+        self.template_by_name = None
+        self.templates_loaded = None
+
+    def invalidate_workflows(self):
+        self.workflow_info = None
+        self.workflows_loaded = None
+
+    def invalidate(self):
+        self.invalidate_hardware()
+        self.invalidate_templates()
+        self.invalidate_workflows()
+
+    def cache_fresh(self, entity, loaded):
+        return loaded is not None and \
+            time.monotonic() - loaded < self.cache_ttl[entity]
+
+    def remember_hardware(self, record):
+        self.forget_hardware(record.id)
+        if self.hardware_info is not None:
+            self.hardware_info.append(record)
+            self.hardware_by_id[record.id] = record
+            self.hardware_by_mac[record.mac] = record
+            self.hardware_by_host[record.host] = record
+
+    def forget_hardware(self, hardware_id):
+        self.hardware_metadata.pop(hardware_id, None)
+        if self.hardware_info is None:
+            return
+        re = self.hardware_by_id.pop(hardware_id, None)
+        if re is None:
+            return
+        self.hardware_info.remove(re)
+        if self.hardware_by_mac.get(re.mac) is re:
+            del self.hardware_by_mac[re.mac]
+        if self.hardware_by_host.get(re.host) is re:
+            del self.hardware_by_host[re.host]
+
+    def remember_template(self, record):
+        self.forget_template(record.id)
+        if self.template_info is not None:
+            self.template_info.append(record)
+            self.template_by_id[record.id] = record
+            self.template_by_name[record.name] = record
+
+    def forget_template(self, template_id):
+        if self.template_info is None:
+            return
+        re = self.template_by_id.pop(template_id, None)
+        if re is None:
+            return
+        self.template_info.remove(re)
+        if self.template_by_name.get(re.name) is re:
+            del self.template_by_name[re.name]
+
+    def remember_workflow(self, record):
+        if self.workflow_info is not None:
+            self.workflow_info.append(record)
+
+    def forget_workflow(self, workflow_id):
+        if self.workflow_info is not None:
+            self.workflow_info = [re for re in self.workflow_info
+                                  if re.id != workflow_id]
+
+    def get_host_for_mac2(self, mac):
+        resp = None
+        try:
+            req = hardware_pb2.GetRequest(mac=mac.lower())
+            response = self.hardware_stub.ByMAC(req)
+            if len(response.network.interfaces) > 0:
+                resp = response.network.interfaces[0].dhcp.hostname
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.NOT_FOUND:
+                raise
+        return resp
+
+    def get_host_for_mac(self, mac):
+        self.get_all_hardware()
+        re = self.hardware_by_mac.get(mac)
+        return re.host if re is not None else ""
+
+    def get_mac_for_host(self, host):
+        self.get_all_hardware()
+        re = self.hardware_by_host.get(host)
+        return re.mac if re is not None else ""
+
+    def scan_hardware(self):
+        response = self.scan_stub.All(hardware_pb2.GetRequest())
+        result = []
+        for r in response:
+            result.append(hardware_summary(r))
+        self.update_snapshot('hardware', result)
+        return result
+
+    def get_all_hardware(self):
+        if self.cache_fresh('hardware', self.hardware_loaded):
+            return self.hardware_info
+        # concurrent callers wait for one scan instead of each starting their
+        # own, without a lock held across the rpc
+        return self.refills.do('hardware', 'hardware', self.load_hardware)
+
+    def load_hardware(self):
+        if self.cache_fresh('hardware', self.hardware_loaded):
+            return self.hardware_info
+        result = self.scan_hardware()
+        self.hardware_by_id = {re.id: re for re in result}
+        self.hardware_by_mac = {re.mac: re for re in result}
+        self.hardware_by_host = {re.host: re for re in result}
+        self.hardware_info = result
+        self.hardware_loaded = time.monotonic()
+        return result
+
+    def name_maps(self):
+        # fill the caches before a listing is opened: a refill started while
+        # the listing holds its stream slot could wait on that same slot
+        self.get_all_hardware()
+        self.get_all_templates()
+        return self.hardware_by_mac, self.template_by_id
+
+    def get_hardware_name(self, hardware_name):
+        self.get_all_hardware()
+        re = self.hardware_by_host.get(hardware_name)
+        if re is None:
+            return None
+        return self.get_hardware_id(re.id)
+
+    def get_hardware_id(self, hardware_id):
+        response = self.hardware_stub.ByID(hardware_pb2.GetRequest(id=hardware_id))
+        return hardware_summary(response)
+
+    def get_hardware_metadata(self, hardware_id):
+        loaded, metadata = self.hardware_metadata.get(hardware_id, (None, None))
+        if not self.cache_fresh('metadata', loaded):
+            response = self.hardware_stub.ByID(hardware_pb2.GetRequest(id=hardware_id))
+            metadata = packet_pb2.Metadata()
+            if response.metadata != "":
+                ParseDict(json.loads(response.metadata), metadata,
+                          ignore_unknown_fields=True)
+            self.hardware_metadata[hardware_id] = (time.monotonic(), metadata)
+        return metadata
+
+    def scan_templates(self):
+        response = self.template_stub.ListTemplates(template_pb2.GetRequest())
+        result = [TemplateRecord(r.name, r.id) for r in response]
+        self.update_snapshot('templates', result)
+        return result
+
+    def get_all_templates(self):
+        if self.cache_fresh('templates', self.templates_loaded):
+            return self.template_info
+        return self.refills.do('templates', 'templates', self.load_templates)
+
+    def load_templates(self):
+        if self.cache_fresh('templates', self.templates_loaded):
+            return self.template_info
+        result = self.scan_templates()
+        self.template_by_id = {re.id: re for re in result}
+        self.template_by_name = {re.name: re for re in result}
+        self.template_info = result
+        self.templates_loaded = time.monotonic()
+        return result
+
+    def get_template_by_id(self, template_id):
+        self.get_all_templates()
+        return self.template_by_id.get(template_id)
+
+    def get_template_by_name(self, template_name):
+        self.get_all_templates()
+        re = self.template_by_name.get(template_name)
+        return re.id if re is not None else None
+
+    def get_template_steps(self, template_id):
+        data = self.fetch_template_steps(template_id)
+        self.save_template_steps({template_id: data})
+        return data
+
+    def fetch_template_steps(self, template_id):
+        response = self.template_stub.GetTemplate(
+            template_pb2.GetRequest(id=template_id))
+        return response.data
+
+    def save_template_steps(self, fetched):
+        def merge(snapshot):
+            steps = dict(snapshot.get('template_data', {}).get('records', {}))
+            steps.update(fetched)
+            snapshot['template_data'] = {'updated': time.time(), 'records': steps}
+        self.change_snapshot(merge)
+
+    def get_template_steps_by_name(self, template_name):
+        template_id = self.get_template_by_name(template_name)
+        if template_id is None:
+            return None
+        return self.get_template_steps(template_id)
+
+    def get_all_workflows(self):
+        if self.cache_fresh('workflows', self.workflows_loaded):
+            return self.workflow_info
+        return self.refills.do('workflows', 'workflows', self.load_workflows)
+
+    def load_workflows(self):
+        if self.cache_fresh('workflows', self.workflows_loaded):
+            return self.workflow_info
+        result = self.scan_workflows()
+        self.workflow_info = result
+        self.workflows_loaded = time.monotonic()
+        return result
+
+    def scan_workflows(self):
+        hardware_by_mac, template_by_id = self.name_maps()
+        response = self.workflow_stub.ListWorkflows(workflow_pb2.GetRequest())
+        result = []
+        # workflows on the same machine share one device record
+        device_records = {}
+        for r in response:
+            devices = []
+            for mac in json.loads(r.hardware).values():
+                device = device_records.get(mac)
+                if device is None:
+                    hardware = hardware_by_mac.get(mac)
+                    device = DeviceRecord(
+                        hardware.host if hardware is not None else "", mac)
+                    device_records[mac] = device
+                devices.append(device)
+            devices = tuple(devices)
+            result.append(WorkflowRecord(r.id, template_by_id.get(r.template),
+                                         state_map(r.state), devices))
+        self.update_snapshot('workflows', result)
+        return result
+
+    def get_workflow_events(self, workflow_id):
+        res = self.workflow_stub.ShowWorkflowEvents(
+            workflow_pb2.GetRequest(id=workflow_id))
         result = {}
         actions = []
         result['worker_id'] = None
@@ -272,35 +1822,98 @@ def get_workflow_events(server, port, creds, workflow_id):
                 result['worker_id'] = r.worker_id
             if result['task_name'] is None:
                 result['task_name'] = r.task_name
-            action_result = {
-                'action_name': r.action_name,
-                'action_status': state_map(r.action_status),
-                'message': r.message,
-                'timestamp': datetime.fromtimestamp(r.created_at.seconds).strftime(
-                    "%A, %B %d, %Y %I:%M:%S")
-            }
-            if action_result['action_status'] != "Running":
-                action_result['seconds'] = r.seconds
+            action_result = EventRecord(
+                r.action_name, state_map(r.action_status), r.message,
+                datetime.fromtimestamp(r.created_at.seconds).strftime(
+                    "%A, %B %d, %Y %I:%M:%S"))
+            if action_result.action_status != "Running":
+                action_result.seconds = r.seconds
                 result['seconds'] += r.seconds
             actions.append(action_result)
 
         result['actions'] = actions
-    return result
-
-
-def get_workflow_by_workflow_id(server, port, creds, workflow_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
+        return result
+
+    def iter_workflow_rows(self, template_name=None, since=None, until=None):
+        hardware_by_mac, template_by_id = self.name_maps()
+        for r in self.workflow_stub.ListWorkflows(workflow_pb2.GetRequest()):
+            template = template_by_id.get(r.template)
+            template = template.name if template is not None else None
+            if template_name is not None and template != template_name:
+                continue
+            created_at = export_timestamp(r.created_at)
+            if since is not None and created_at < since:
+                continue
+            if until is not None and created_at > until:
+                continue
+            macs = list(json.loads(r.hardware).values())
+            yield [
+                r.id,
+                template,
+                ",".join(hardware_by_mac[mac].host if mac in hardware_by_mac
+                         else "" for mac in macs),
+                ",".join(macs),
+                state_map(r.state),
+                created_at,
+            ]
+
+    def iter_event_rows(self, template_name=None, since=None, until=None):
+        # older workflows can still have events after since, so only until
+        # filters whole workflows. The listing is read to the end first: its
+        # deadline would otherwise also cover every events call below, and
+        # each events stream would wait on the slot the listing holds.
+        workflows = [workflow[:3] for workflow in self.iter_workflow_rows(
+            template_name=template_name, until=until)]
+        for workflow in workflows:
+            workflow_id, template, host = workflow
+            req = workflow_pb2.GetRequest(id=workflow_id)
+            for r in self.workflow_stub.ShowWorkflowEvents(req):
+                created_at = export_timestamp(r.created_at)
+                if since is not None and created_at < since:
+                    continue
+                if until is not None and created_at > until:
+                    continue
+                status = state_map(r.action_status)
+                yield [
+                    workflow_id,
+                    template,
+                    host,
+                    r.action_name,
+                    status,
+                    r.seconds if status != "Running" else None,
+                    created_at,
+                ]
+
+    def export_records(self, export_object, file_format, output,
+                       template_name=None, since=None, until=None):
+        if export_object == "workflows":
+            rows = self.iter_workflow_rows(template_name=template_name,
+                                           since=since, until=until)
+        else:
+            rows = self.iter_event_rows(template_name=template_name,
+                                        since=since, until=until)
+        columns = EXPORT_COLUMNS[export_object]
+        if file_format == "csv":
+            if output is None:
+                return write_csv(rows, columns, sys.stdout)
+            with open(output, 'w', newline='') as out:
+                return write_csv(rows, columns, out)
+        if output is None:
+            raise ValueError(file_format + " export requires output arg")
+        return write_arrow(rows, columns, output, file_format)
+
+    def analyze_actions(self, template_name=None, since=None, until=None):
+        rows = self.iter_event_rows(template_name=template_name, since=since,
+                                    until=until)
+        return action_statistics(rows)
+
+    def get_workflow_by_workflow_id(self, workflow_id):
         req = workflow_pb2.WorkflowContextRequest(workflow_id=workflow_id)
-        response = stub.GetWorkflowContexts(req)
-        return response
+        return self.workflow_stub.GetWorkflowContexts(req)
 
-
-def get_workflow_by_hardware_id(server, port, creds, hardware_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
+    def get_workflow_by_hardware_id(self, hardware_id):
         req = workflow_pb2.WorkflowContextRequest(worker_id=hardware_id)
-        response = stub.GetWorkflowContextList(req)
+        response = self.workflow_stub.GetWorkflowContextList(req)
         res = []
         for context in response.workflow_contexts:
             r = {
@@ -313,131 +1926,344 @@ def get_workflow_by_hardware_id(server, port, creds, hardware_id):
                 'total_number_of_actions': context.total_number_of_actions,
             }
             res.append(r)
-    return res
+        return res
 
+    def get_workflow_by_host(self, host):
+        hardware_info = self.get_hardware_name(host)
+        return self.get_workflow_by_hardware_id(hardware_info['id'])
 
-def get_workflow_by_host(server, port, creds, host):
-    hardware_info = get_hardware_name(server, port, creds, host)
-    result = get_workflow_by_hardware_id(server, port, creds, hardware_info['id'])
-    return result
+    def get_workflows_by_host(self, host):
+        res = self.get_all_workflows()
+        result = []
+        for re in res:
+            for device in re['devices']:
+                if device['host'] == host:
+                    result.append(re)
+        return result
+
+    def get_active_workflow_ids(self, hosts):
+        hosts = set(hosts)
+        result = {}
+        for re in self.get_all_workflows():
+            for device in re['devices']:
+                if device['host'] not in hosts:
+                    continue
+                # a pending or running workflow wins over finished ones
+                if device['host'] not in result or \
+                        re['state'] in ("Pending", "Running"):
+                    result[device['host']] = re['id']
+        return result
+
+    def get_workflow_contexts(self, workflow_ids, workers):
+        by_worker = {}
+        for workflow_id in workflow_ids:
+            by_worker.setdefault(workers.get(workflow_id), []).append(workflow_id)
+        result = {}
+        for worker, ids in by_worker.items():
+            if worker and len(ids) > 1:
+                # one stream covers every workflow assigned to the worker
+                req = workflow_pb2.WorkflowContextRequest(worker_id=worker)
+                for context in self.workflow_stub.GetWorkflowContexts(req):
+                    result[context.workflow_id] = context
+            for workflow_id in ids:
+                if workflow_id in result:
+                    continue
+                try:
+                    result[workflow_id] = self.workflow_stub.GetWorkflowContext(
+                        workflow_pb2.GetRequest(id=workflow_id))
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.NOT_FOUND:
+                        raise
+                    result[workflow_id] = None
+        return result
+
+    def wait_workflows(self, workflow_ids, interval=1.0, max_interval=10.0):
+        pending = list(dict.fromkeys(workflow_ids))
+        result = {}
+        last_seen = {}
+        workers = {}
+        delay = interval
+        while pending:
+            changed = False
+            contexts = self.get_workflow_contexts(pending, workers)
+            for workflow_id in list(pending):
+                context = contexts[workflow_id]
+                if context is None:
+                    result[workflow_id] = {'id': workflow_id, 'state': "Unknown",
+                                           'current_action': None}
+                    pending.remove(workflow_id)
+                    continue
+                workers[workflow_id] = context.current_worker
+                seen = (context.current_action_index, context.current_action_state)
+                if last_seen.get(workflow_id) != seen:
+                    last_seen[workflow_id] = seen
+                    changed = True
+                outcome = workflow_outcome(context)
+                if outcome is not None:
+                    result[workflow_id] = {'id': workflow_id, 'state': outcome,
+                                           'current_action': context.current_action}
+                    pending.remove(workflow_id)
+            if not pending:
+                break
+            # poll quickly while workflows are moving, back off while idle
+            delay = interval if changed else min(delay * 2, max_interval)
+            time.sleep(delay)
+        return [result[workflow_id] for workflow_id in dict.fromkeys(workflow_ids)]
+
+    def push_hardware(self, hardware_file, workers=None):
+        records = prepare_hardware_files(hardware_files(hardware_file), workers)
+        check_duplicates(records, self.get_all_hardware())
+        errors = [re['file'] + ": " + ", ".join(re['errors'])
+                  for re in records if re['errors']]
+        if errors:
+            raise ValueError("\n".join(errors))
 
+        result = []
+        for record in records:
+            hardware_wrapper = hardware_pb2.Hardware.FromString(record['data'])
+            self.hardware_stub.Push(hardware_pb2.PushRequest(data=hardware_wrapper))
+            self.remember_hardware(hardware_summary(hardware_wrapper))
+            result.append(hardware_wrapper.id)
+        if self.hardware_info is not None:
+            self.update_snapshot('hardware', self.hardware_info)
+        return result
+
+    def sync(self, directory, prune=False, dry_run=False, workers=None):
+        hardware_paths, template_paths = desired_files(directory)
+        records = prepare_hardware_files(hardware_paths, workers)
+        desired_templates = {}
+        for path in template_paths:
+            with open(path) as my_file:
+                data = my_file.read()
+            desired_templates[yaml.safe_load(data)['name']] = data
+
+        current_hardware = {}
+        for r in self.hardware_stub.All(hardware_pb2.GetRequest()):
+            current_hardware[r.id] = r
+        desired_ids = {re['keys']['id'] for re in records if not re['errors']}
+        check_duplicates(records, [hardware_summary(r)
+                                   for r in current_hardware.values()
+                                   if r.id not in desired_ids])
+        errors = [re['file'] + ": " + ", ".join(re['errors'])
+                  for re in records if re['errors']]
+        if errors:
+            raise ValueError("\n".join(errors))
+
+        plan = []
+        for record in records:
+            hardware_wrapper = hardware_pb2.Hardware.FromString(record['data'])
+            current = current_hardware.get(hardware_wrapper.id)
+            if current is None:
+                plan.append(('create', 'hardware', hardware_wrapper.id,
+                             hardware_wrapper))
+            elif hardware_digest(current) != hardware_digest(hardware_wrapper):
+                plan.append(('update', 'hardware', hardware_wrapper.id,
+                             hardware_wrapper))
+        for hardware_id in sorted(set(current_hardware) - desired_ids):
+            plan.append(('delete', 'hardware', hardware_id, None))
+
+        current_templates = {re['name']: re['id'] for re in self.get_all_templates()}
+        existing = [current_templates[name] for name in desired_templates
+                    if name in current_templates]
+        with futures.ThreadPoolExecutor(max_workers=workers or 8) as executor:
+            current_steps = dict(zip(existing, executor.map(
+                self.fetch_template_steps, existing)))
+        if current_steps:
+            self.save_template_steps(current_steps)
+        for name, data in sorted(desired_templates.items()):
+            if name not in current_templates:
+                plan.append(('create', 'template', name, data))
+            elif template_digest(current_steps[current_templates[name]]) \
+                    != template_digest(data):
+                plan.append(('update', 'template', name, data))
+        for name in sorted(set(current_templates) - set(desired_templates)):
+            plan.append(('delete', 'template', name, None))
+
+        def apply(change):
+            action, kind, key, value = change
+            if kind == 'hardware' and action == 'delete':
+                self.hardware_stub.Delete(hardware_pb2.DeleteRequest(id=key))
+            elif kind == 'hardware':
+                self.hardware_stub.Push(hardware_pb2.PushRequest(data=value))
+            elif action == 'create':
+                req = template_pb2.WorkflowTemplate(name=key, data=value)
+                self.template_stub.CreateTemplate(req)
+            elif action == 'update':
+                req = template_pb2.WorkflowTemplate(name=key, data=value,
+                                                    id=current_templates[key])
+                self.template_stub.UpdateTemplate(req)
+            else:
+                req = template_pb2.GetRequest(id=current_templates[key])
+                self.template_stub.DeleteTemplate(req)
 
-def get_workflows_by_host(server, port, creds, host):
-    res = get_all_workflows(server, port, creds)
-    result = []
-    for re in res:
-        for device in re['devices']:
-            if device['host'] == host:
+        result = []
+        pending = []
+        with futures.ThreadPoolExecutor(max_workers=workers or 8) as executor:
+            for change in plan:
+                re = {'action': change[0], 'kind': change[1], 'key': change[2]}
+                if dry_run or (change[0] == 'delete' and not prune):
+                    re['applied'] = False
+                else:
+                    pending.append((re, change, executor.submit(apply, change)))
                 result.append(re)
-    return result
-
-
-def push_hardware(server, port, creds, hardware_file):
-    with open(hardware_file) as my_file:
-        data = my_file.read()
-
-    hardware = json.loads(data)
-    hardware_id = hardware['id']
-    hardware_hostname = hardware['network']['interfaces'][0]['dhcp']['hostname']
-    hardware_ip = hardware['network']['interfaces'][0]['dhcp']['ip']['address']
-    hardware_mac = hardware['network']['interfaces'][0]['dhcp']['mac']
-    if len(hardware['network']['interfaces']) != 1:
-        raise ValueError("Must specify exactly one IP per host")
-    hardware_info = get_all_hardware(server=server, port=port, creds=creds)
-    for existing in hardware_info:
-        if existing['host'].lower == hardware_hostname.lower():
-            raise ValueError("Duplicate hostname")
-        if existing['ip'] == hardware_ip:
-            raise ValueError("Duplicate IP")
-        if existing['mac'].lower() == hardware_mac.lower():
-            raise ValueError("Duplicate MAC address")
-        if existing['id'] == hardware_id:
-            raise ValueError("Duplicate hardware ID")
-    hardware_wrapper = hardware_pb2.Hardware()
-    nw = Parse(json.dumps(hardware['network']), hardware_wrapper.network)
-    hardware_wrapper.id = hardware['id']
-    for ele in hardware_wrapper.id:
-        if ele.isupper():
-            raise ValueError('Uppercase in Id')
-    for ele in hardware_mac:
-        if ele.isupper():
-            raise ValueError('Uppercase in MAC')
-    hardware_wrapper.metadata = json.dumps(hardware['metadata'], separators=(',', ':'))
-    hardware_wrapper.network.CopyFrom(nw)
-
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = hardware_pb2_grpc.HardwareServiceStub(channel)
-        req = hardware_pb2.PushRequest(data=hardware_wrapper)
-        stub.Push(req)
-    return [hardware['id']]
-
-
-def push_template(server, port, creds, template_file):
-    with open(template_file) as my_file:
-        data = my_file.read()
-
-    template_data = yaml.load(data, Loader=yaml.Loader)
-    template_name = template_data['name']
-    existing_template = get_template_by_name(server, port, creds, template_name)
-    if existing_template is not None:
-        delete_template(server, port, creds, existing_template)
-    template_id = get_template_by_name(server, port, creds, template_name)
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = template_pb2_grpc.TemplateServiceStub(channel)
+            for re, change, future in pending:
+                try:
+                    future.result()
+                    re['applied'] = True
+                except grpc.RpcError as e:
+                    re['applied'] = False
+                    re['error'] = e.details()
+        if pending:
+            self.invalidate()
+            # like delete_*, keep the offline snapshot and completion indexes
+            # from offering what was just removed or replaced
+            applied = [change for re, change, _ in pending if re['applied']]
+            self.drop_snapshot_records('hardware', [
+                key for action, kind, key, _ in applied
+                if kind == 'hardware' and action == 'delete'])
+            removed = [current_templates[key] for action, kind, key, _ in applied
+                       if kind == 'template' and action == 'delete']
+            self.drop_snapshot_records('templates', removed)
+            self.drop_snapshot_records('template_data', removed + [
+                current_templates[key] for action, kind, key, _ in applied
+                if kind == 'template' and action == 'update'])
+        return result
+
+    def push_template(self, template_file):
+        with open(template_file) as my_file:
+            data = my_file.read()
+
+        template_data = yaml.load(data, Loader=yaml.Loader)
+        template_name = template_data['name']
+        existing_template = self.get_template_by_name(template_name)
+        if existing_template is not None:
+            self.delete_template(existing_template)
+        template_id = self.get_template_by_name(template_name)
         if template_id is None:
             req = template_pb2.WorkflowTemplate(name=template_name, data=data)
-            stub.CreateTemplate(req)
-            template_id = get_template_by_name(server, port, creds, template_name)
+            template_id = self.template_stub.CreateTemplate(req).id
+            self.remember_template(TemplateRecord(template_name, template_id))
+            self.update_snapshot('templates', self.template_info)
         else:
             req = template_pb2.WorkflowTemplate(name=template_name, data=data,
                                                 id=template_id)
-            stub.UpdateTemplate(req)
-    return [template_id]
+            self.template_stub.UpdateTemplate(req)
+        return [template_id]
 
-
-def push_workflow(server, port, creds, client_name, template_name):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
-        client_mac = get_mac_for_host(server, port, creds, client_name)
+    def push_workflow(self, client_name, template_name):
+        client_mac = self.get_mac_for_host(client_name)
         if client_mac == "":
             raise Exception("Invalid host")
-        template_id = get_template_by_name(server, port, creds, template_name)
+        template_id = self.get_template_by_name(template_name)
         if template_id is None:
             raise Exception("Invalid template name")
         hardware = {'device_1': client_mac}
         hardware_json = json.dumps(hardware)
-        existing_workflows = get_workflows_by_host(server=server, port=port,
-                                                   creds=creds, host=client_name)
-        for workflow in existing_workflows:
+        for workflow in self.get_workflows_by_host(client_name):
             if workflow['devices'][0]['host'].lower() == client_name.lower():
                 if workflow['state'] == "Running":
                     raise ValueError("Running workflow exists for host")
                 if workflow['state'] == "Pending":
                     raise ValueError("Pending workflow exists for host")
-        response = stub.CreateWorkflow(workflow_pb2.CreateRequest(
+        response = self.workflow_stub.CreateWorkflow(workflow_pb2.CreateRequest(
             template=template_id, hardware=hardware_json))
-    return [response.id]
+        self.remember_workflow(WorkflowRecord(
+            response.id, self.get_template_by_id(template_id), "Pending",
+            (DeviceRecord(client_name, client_mac),)))
+        return [response.id]
+
+    def delete_hardware(self, hardware_id):
+        self.hardware_stub.Delete(hardware_pb2.DeleteRequest(id=hardware_id))
+        self.forget_hardware(hardware_id)
+        self.drop_snapshot_records('hardware', [hardware_id])
+        return True
+
+    def delete_template(self, template_id):
+        self.template_stub.DeleteTemplate(template_pb2.GetRequest(id=template_id))
+        self.forget_template(template_id)
+        self.drop_snapshot_records('templates', [template_id])
+        self.drop_snapshot_records('template_data', [template_id])
+        return True
+
+    def delete_workflow(self, workflow_id):
+        self.workflow_stub.DeleteWorkflow(workflow_pb2.GetRequest(id=workflow_id))
+        self.forget_workflow(workflow_id)
+        self.drop_snapshot_records('workflows', [workflow_id])
+        return True
+
+
+class OfflineError(Exception):
+    """What was asked for needs live data the offline snapshot doesn't have."""
+
+
+class OfflineTinkClient(TinkClient):
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.snapshot_file = snapshot_path(name, port)
+        self.snapshot = None
+        self.snapshot_updated = None
+        self.policy = CallPolicy()
+        self.cache_ttl = dict(CACHE_TTLS)
+        self.refills = Singleflight()
+        self.invalidate()
+
+    def close(self):
+        pass
 
+    def offline_records(self, section):
+        snapshot = self.load_snapshot()
+        if section not in snapshot:
+            raise OfflineError("No offline snapshot of " + section + " for "
+                               + self.name)
+        updated = snapshot[section]['updated']
+        if self.snapshot_updated is None or updated < self.snapshot_updated:
+            self.snapshot_updated = updated
+        record_type = SNAPSHOT_RECORDS.get(section)
+        if record_type is None:
+            return snapshot[section]['records']
+        return [record_type.from_dict(re) for re in snapshot[section]['records']]
+
+    def change_snapshot(self, change):
+        pass
 
-def delete_hardware(server, port, creds, hardware_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = hardware_pb2_grpc.HardwareServiceStub(channel)
-        stub.Delete(hardware_pb2.DeleteRequest(id=hardware_id))
-    return True
+    def flush_snapshot(self):
+        pass
 
+    def staleness(self):
+        if self.snapshot_updated is None:
+            return None
+        age = int(time.time() - self.snapshot_updated)
+        taken = datetime.fromtimestamp(self.snapshot_updated, tz=timezone.utc)
+        return ("STALE: offline snapshot of " + self.name + " taken at "
+                + taken.isoformat() + " (" + str(age // 60) + " minutes old)")
 
-def delete_template(server, port, creds, template_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = template_pb2_grpc.TemplateServiceStub(channel)
-        stub.DeleteTemplate(template_pb2.GetRequest(id=template_id))
-    return True
+    def scan_hardware(self):
+        return self.offline_records('hardware')
 
+    def scan_templates(self):
+        return self.offline_records('templates')
 
-def delete_workflow(server, port, creds, workflow_id):
-    with grpc.secure_channel(server + ":" + port, creds) as channel:
-        stub = workflow_pb2_grpc.WorkflowServiceStub(channel)
-        stub.DeleteWorkflow(workflow_pb2.GetRequest(id=workflow_id))
-    return True
+    def get_hardware_id(self, hardware_id):
+        for re in self.get_all_hardware():
+            if re['id'] == hardware_id:
+                return re
+        return None
+
+    def get_template_steps(self, template_id):
+        return self.offline_records('template_data').get(template_id)
+
+    def scan_workflows(self):
+        return self.offline_records('workflows')
+
+    def get_hardware_metadata(self, hardware_id):
+        raise OfflineError("Hardware metadata is not available offline")
+
+    def get_workflow_events(self, workflow_id):
+        raise OfflineError("Workflow events are not available offline")
+
+    def get_workflow_by_hardware_id(self, hardware_id):
+        raise OfflineError("Workflow contexts are not available offline")
 
 
 def ipmi_boot_pxe(host, username, password):
@@ -446,123 +2272,1045 @@ def ipmi_boot_pxe(host, username, password):
     ipmi_cmd.set_power("boot")
 
 
-def run():
-    parser = create_parser()
-    args = parser.parse_args()
+def reboot_host(client, host):
+    if ipmi_userid is None or ipmi_password is None:
+        return False
+    hardware_info = client.get_hardware_name("ipmi." + host)
+    if hardware_info is None:
+        return False
+    ipmi_boot_pxe(host=hardware_info['ip'], username=ipmi_userid,
+                  password=ipmi_password)
+    return True
 
-    if args.tink_host is None:
-        print("TINK_HOST environment variable must be set or --host must be specified")
-        return
 
-    args.tink_host = socket.gethostbyname(args.tink_host)
+def workflow_outcome(context):
+    state = state_map(context.current_action_state)
+    if state in ("Failed", "Timeout"):
+        return state
+    if state == "Success" and \
+            context.current_action_index >= context.total_number_of_actions - 1:
+        return state
+    return None
+
+
+def read_hosts_file(hosts_file):
+    with open(hosts_file) as my_file:
+        return [line.strip() for line in my_file
+                if line.strip() != "" and not line.strip().startswith("#")]
+
+
+def provision(client, hosts, template_name, max_running, state_file, interval=10.0):
+    state = {'template': template_name, 'hosts': {}}
+    if os.path.exists(state_file):
+        with open(state_file) as my_file:
+            state = json.load(my_file)
+        if state['template'] != template_name:
+            raise ValueError("State file " + state_file + " is for template "
+                             + state['template'])
+    for host in hosts:
+        state['hosts'].setdefault(host, {'status': "queued"})
+    write_json(state_file, state)
+
+    def log(host, message):
+        print(host + ": " + message, file=sys.stderr, flush=True)
+
+    while True:
+        running = [host for host, re in state['hosts'].items()
+                   if re['status'] == "running"]
+        for host in list(running):
+            re = state['hosts'][host]
+            req = workflow_pb2.GetRequest(id=re['workflow_id'])
+            try:
+                outcome = workflow_outcome(
+                    client.workflow_stub.GetWorkflowContext(req))
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.NOT_FOUND:
+                    log(host, "could not check workflow: " + str(e.details()))
+                    continue
+                # deleted behind our back, it will never finish
+                outcome = "Unknown"
+            if outcome is not None:
+                re['status'] = outcome
+                running.remove(host)
+                log(host, "workflow " + re['workflow_id'] + " " + outcome)
+                write_json(state_file, state)
+        queued = [host for host, re in state['hosts'].items()
+                  if re['status'] == "queued"]
+        for host in queued[:max(0, max_running - len(running))]:
+            re = state['hosts'][host]
+            try:
+                re['workflow_id'] = client.push_workflow(host, template_name)[0]
+                re['status'] = "running"
+            except (Exception, grpc.RpcError) as e:
+                re['status'] = "error"
+                re['error'] = str(e)
+                log(host, "failed to start: " + str(e))
+            if re['status'] == "running":
+                try:
+                    if reboot_host(client, host):
+                        log(host, "started workflow " + re['workflow_id'])
+                    elif ipmi_userid is None or ipmi_password is None:
+                        raise Exception("IPMI_USER and IPMI_PASS are not set")
+                    else:
+                        raise Exception("no ipmi." + host + " record")
+                except Exception as e:
+                    # a host that never boots would hold its slot forever, drop
+                    # the workflow so a later run can start it again
+                    re['status'] = "error"
+                    re['error'] = "PXE boot failed: " + str(e)
+                    log(host, re['error'])
+                    try:
+                        client.delete_workflow(re['workflow_id'])
+                    except grpc.RpcError as e:
+                        log(host, "could not delete workflow: " + str(e.details()))
+            write_json(state_file, state)
+        if not queued and not running:
+            break
+        time.sleep(interval)
+
+    return [dict(host=host, **re) for host, re in state['hosts'].items()]
+
+
+class WorkflowWatcher:
+    """Polls tink once per interval and tells every subscriber what changed.
+
+    Each tick reads ListWorkflows for workflow states and the contexts of
+    pending and running workflows for action progress, so the load on tink
+    does not grow with the number of subscribers.
+    """
+
+    def __init__(self, client, hosts=None, interval=10.0):
+        self.client = client
+        self.hosts = set(hosts) if hosts is not None else None
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self.workflows = {}
+        self.workers = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.polled = False
+
+    def subscribe(self, callback):
+        # late subscribers first hear the current state of every workflow
+        with self.lock:
+            for workflow in self.workflows.values():
+                callback(dict(workflow, event="workflow", previous_state=None,
+                              initial=True))
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback, stop_idle=False):
+        with self.lock:
+            self.subscribers.remove(callback)
+            if stop_idle and not self.subscribers:
+                # nobody is listening, stop polling tink until someone is
+                self.stop()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # each run gets its own event so a stopped poll thread can not
+                # be revived by a restart that follows it
+                self.stopped = threading.Event()
+                self.thread = threading.Thread(target=self.run,
+                                               args=(self.stopped,), daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped.set()
+            self.thread = None
+            # a restarted watcher reports current states afresh
+            self.workflows = {}
+            self.workers = {}
+            self.polled = False
+
+    def run(self, stopped=None):
+        stopped = stopped if stopped is not None else self.stopped
+        while not stopped.is_set():
+            try:
+                self.poll(stopped)
+            except grpc.RpcError as e:
+                logging.warning("Watching workflows failed: %s", e.details())
+            stopped.wait(self.interval)
+
+    def emit(self, event):
+        event['time'] = datetime.now(tz=timezone.utc).isoformat()
+        for callback in list(self.subscribers):
+            callback(event)
+
+    def poll(self, stopped=None):
+        hardware_by_mac, _ = self.client.name_maps()
+        current = {}
+        for r in self.client.workflow_stub.ListWorkflows(workflow_pb2.GetRequest()):
+            hosts = [hardware_by_mac[mac].host if mac in hardware_by_mac else ""
+                     for mac in json.loads(r.hardware).values()]
+            if self.hosts is not None and not self.hosts.intersection(hosts):
+                continue
+            current[r.id] = {'workflow_id': r.id, 'host': ",".join(hosts),
+                             'state': state_map(r.state)}
+        active = [workflow_id for workflow_id, workflow in current.items()
+                  if workflow['state'] in ("Pending", "Running")]
+        contexts = self.client.get_workflow_contexts(active, self.workers)
+        with self.lock:
+            if stopped is not None and stopped.is_set():
+                return
+            for workflow_id, workflow in current.items():
+                previous = self.workflows.get(workflow_id, {})
+                # worker streams also carry workflows that have already finished
+                context = contexts.get(workflow_id) if workflow_id in active else None
+                if context is not None:
+                    self.workers[workflow_id] = context.current_worker
+                    workflow['action'] = context.current_action
+                    workflow['action_index'] = context.current_action_index
+                    workflow['action_state'] = state_map(context.current_action_state)
+                    workflow['total_actions'] = context.total_number_of_actions
+                else:
+                    for key in ('action', 'action_index', 'action_state',
+                                'total_actions'):
+                        if key in previous:
+                            workflow[key] = previous[key]
+                if previous.get('state') != workflow['state']:
+                    # workflows found by the first poll were not seen change
+                    self.emit(dict(workflow, event="workflow",
+                                   previous_state=previous.get('state'),
+                                   initial=not self.polled))
+                elif context is not None and \
+                        (previous.get('action_index'), previous.get('action_state')) \
+                        != (workflow['action_index'], workflow['action_state']):
+                    self.emit(dict(workflow, event="action",
+                                   previous_action=previous.get('action'),
+                                   previous_action_state=previous.get('action_state')))
+            for workflow_id in set(self.workflows) - set(current):
+                workflow = self.workflows[workflow_id]
+                self.workers.pop(workflow_id, None)
+                self.emit(dict(workflow, event="workflow", state="Deleted",
+                               previous_state=workflow['state'], initial=False))
+            self.workflows = current
+            self.polled = True
+
+
+class Hook:
+    def __init__(self, name, when, command=None, url=None, timeout=300, retries=5):
+        if (command is None) == (url is None):
+            raise ValueError("Hook " + name + " needs exactly one of command or url")
+        self.name = name
+        self.transitions = []
+        for item in when if isinstance(when, list) else [when]:
+            previous, _, state = item.rpartition("->")
+            self.transitions.append((previous.strip() or None, state.strip()))
+        self.command = shlex.split(command) if isinstance(command, str) else command
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+
+    def matches(self, previous, state):
+        return any(state == to and (source is None or previous == source)
+                   for source, to in self.transitions)
+
+    def run(self, event):
+        fields = {key: "" if value is None else value for key, value in event.items()}
+        if self.url is not None:
+            req = urllib.request.Request(
+                self.url, data=json.dumps(event).encode(), method="POST",
+                headers={'Content-Type': "application/json"})
+            with urllib.request.urlopen(req, timeout=self.timeout):
+                pass
+            return
+        env = dict(os.environ)
+        env.update({'TINK_' + key.upper(): str(value) for key, value in fields.items()})
+        subprocess.run([self.expand(part, fields) for part in self.command], env=env,
+                       stdin=subprocess.DEVNULL, timeout=self.timeout, check=True)
+
+    @staticmethod
+    def expand(part, fields):
+        # imported here, this module uses re for records everywhere
+        import re
+
+        # only {field} placeholders are replaced, other braces (awk, json) stay,
+        # and in one pass so values from tink are never expanded themselves
+        def value(match):
+            key = match.group(1)
+            return str(fields[key]) if key in fields else match.group(0)
+        return re.sub(r"\{(\w+)\}", value, part)
+
+
+class HookRunner:
+    """Runs hooks for workflow transitions seen by a WorkflowWatcher.
+
+    The last state of every workflow, the hooks that succeeded and the ones
+    still failing are kept in state_file. After a restart, transitions missed
+    while down still fire, hooks that succeeded do not run again and failed
+    ones are retried.
+    """
+
+    def __init__(self, hooks, state_file, workers=4):
+        self.hooks = hooks
+        self.state_file = state_file
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.baseline = not os.path.exists(state_file)
+        state = {'states': {}, 'done': [], 'failed': {}}
+        if not self.baseline:
+            with open(state_file) as my_file:
+                state = json.load(my_file)
+        self.states = state['states']
+        self.done = set(state['done'])
+        self.failed = state.get('failed', {})
+        self.running = set()
+        self.saved = 0.0
+        hooks_by_name = {hook.name: hook for hook in hooks}
+        for key, failure in self.failed.items():
+            hook = hooks_by_name.get(failure['hook'])
+            if hook is not None:
+                self.running.add(key)
+                self.submit(hook, key, failure['event'])
+
+    @classmethod
+    def from_file(cls, hooks_file, state_file=None, workers=None):
+        with open(hooks_file) as my_file:
+            config = yaml.safe_load(my_file)
+        hooks = [Hook(hook.get('name', "hook" + str(number)), hook['when'],
+                      command=hook.get('command'), url=hook.get('url'),
+                      timeout=hook.get('timeout', 300),
+                      retries=hook.get('retries', 5))
+                 for number, hook in enumerate(config['hooks'])]
+        if state_file is None:
+            state_file = config.get('state_file', hooks_file + ".state.json")
+        return cls(hooks, state_file, workers=workers or config.get('workers', 4))
+
+    def __call__(self, event):
+        if event['event'] != "workflow":
+            return
+        workflow_id = event['workflow_id']
+        with self.lock:
+            previous = event['previous_state']
+            if previous is None:
+                previous = self.states.get(workflow_id)
+            if event['state'] == "Deleted":
+                self.states.pop(workflow_id, None)
+            else:
+                self.states[workflow_id] = event['state']
+            # the first run only learns the current states, history fires nothing
+            if self.baseline and event['initial']:
+                return
+            if previous == event['state']:
+                return
+            for hook in self.hooks:
+                key = workflow_id + ":" + event['state'] + ":" + hook.name
+                if key in self.done or key in self.running or \
+                        not hook.matches(previous, event['state']):
+                    continue
+                self.running.add(key)
+                self.submit(hook, key, dict(event, previous_state=previous))
+        self.save()
+
+    def submit(self, hook, key, event, attempt=0):
+        try:
+            self.executor.submit(self.run_hook, hook, key, event, attempt)
+        except RuntimeError:
+            # shut down while waiting to retry, the failure stays in state_file
+            pass
+
+    def run_hook(self, hook, key, event, attempt=0):
+        try:
+            hook.run(event)
+        except Exception as e:
+            with self.lock:
+                self.failed[key] = {'hook': hook.name, 'event': event}
+                if attempt >= hook.retries:
+                    self.running.discard(key)
+            if attempt < hook.retries:
+                delay = min(HOOK_RETRY_DELAY * 2 ** attempt, HOOK_MAX_RETRY_DELAY)
+                logging.warning("Hook %s failed for workflow %s, retrying in %gs: %s",
+                                hook.name, event['workflow_id'], delay, e)
+                retry = threading.Timer(delay, self.submit,
+                                        (hook, key, event, attempt + 1))
+                retry.daemon = True
+                retry.start()
+            else:
+                logging.error("Hook %s failed for workflow %s, giving up until "
+                              "restart: %s", hook.name, event['workflow_id'], e)
+            self.save(force=True)
+            return
+        with self.lock:
+            self.running.discard(key)
+            self.failed.pop(key, None)
+            self.done.add(key)
+        self.save(force=True)
+
+    def save(self, force=False):
+        with self.lock:
+            if not force and time.monotonic() - self.saved < 1.0:
+                return
+            self.saved = time.monotonic()
+            # keep run markers only for workflows tink still has
+            self.done = {key for key in self.done
+                         if key.split(":", 1)[0] in self.states}
+            self.failed = {key: failure for key, failure in self.failed.items()
+                           if key.split(":", 1)[0] in self.states}
+            write_json(self.state_file, {'states': self.states,
+                                         'done': sorted(self.done),
+                                         'failed': self.failed})
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.save(force=True)
+
+
+def record_matches(re, query):
+    for key, values in query.items():
+        if key == 'host' and 'devices' in re.keys():
+            value = [device.host for device in re.devices]
+        elif key == 'template' and 'devices' in re.keys():
+            value = [re.template.name if re.template is not None else None]
+        else:
+            value = [re.get(key)]
+        if not any(str(item) in values for item in value):
+            return False
+    return True
+
 
-    cert_url = 'http://' + args.tink_host + ':' + args.http_port + '/cert'
-    with urllib.request.urlopen(cert_url) as response:
-        trusted_certs = response.read()
+class HttpGateway:
+    """Read only JSON view of one warm client for tools that don't speak grpc."""
 
-    creds = grpc.ssl_channel_credentials(root_certificates=trusted_certs)
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 502: "Bad Gateway"}
 
+    def __init__(self, client, workers=None, interval=10.0):
+        self.client = client
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers or 16)
+        self.watcher = WorkflowWatcher(client, interval=interval)
+        self.routes = {
+            'hardware': client.get_all_hardware,
+            'templates': client.get_all_templates,
+            'workflows': client.get_all_workflows,
+        }
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, int(port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            parts = request.decode('latin-1').split()
+            if len(parts) != 3:
+                status, body = 400, {'error': "Malformed request"}
+            elif parts[0] != "GET":
+                status, body = 405, {'error': "Only GET is supported"}
+            elif urllib.parse.urlsplit(parts[1]).path.rstrip("/") == "/events":
+                await self.stream_events(reader, writer, parts[1], headers)
+                return
+            else:
+                status, body = await self.route(parts[1])
+            data = json.dumps(body).encode()
+            writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                          "Content-Length: %d\r\nConnection: close\r\n\r\n"
+                          % (status, self.REASONS[status], len(data))).encode())
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target):
+        url = urllib.parse.urlsplit(target)
+        path = url.path.strip("/").split("/")
+        query = urllib.parse.parse_qs(url.query)
+        loop = asyncio.get_running_loop()
+        try:
+            if len(path) == 1 and path[0] in self.routes:
+                records = await loop.run_in_executor(self.executor,
+                                                     self.routes[path[0]])
+                return 200, [re.to_dict() for re in records
+                             if record_matches(re, query)]
+            if len(path) == 3 and path[0] == "workflows" and path[2] == "events":
+                events = await loop.run_in_executor(
+                    self.executor, self.client.get_workflow_events, path[1])
+                return 200, as_dict(events)
+        except grpc.RpcError as e:
+            return 502, {'error': e.details()}
+        except Exception as e:
+            return 502, {'error': str(e)}
+        return 404, {'error': "Path must be one of: /hardware, /templates, "
+                              "/workflows, /workflows/{id}/events, /events"}
+
+    async def stream_events(self, reader, writer, target, headers):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+        hosts = set(query.get('host', []))
+        sse = query.get('format', [""])[0] == "sse" or \
+            "text/event-stream" in headers.get('accept', "")
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def deliver(event):
+            if not hosts or hosts.intersection(event['host'].split(",")):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+
+        writer.write(("HTTP/1.1 200 OK\r\nContent-Type: %s\r\n"
+                      "Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+                      % ("text/event-stream" if sse else "application/x-ndjson"))
+                     .encode())
+        await writer.drain()
+        await loop.run_in_executor(self.executor, self.watcher.subscribe, deliver)
+        self.watcher.start()
+        # the client sends nothing more, so this read only ends when it hangs up
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                getter = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({getter, closed}, timeout=15,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    if closed in done:
+                        break
+                    # keep idle connections open through proxies
+                    writer.write(b": ping\n\n" if sse else b"\n")
+                else:
+                    event = getter.result()
+                    # a consumer this far behind is cut off and can reconnect
+                    if events.qsize() > 10000:
+                        break
+                    data = json.dumps(event)
+                    if sse:
+                        writer.write(("event: " + event['event'] + "\ndata: " + data
+                                      + "\n\n").encode())
+                    else:
+                        writer.write((data + "\n").encode())
+                await writer.drain()
+        finally:
+            closed.cancel()
+            self.watcher.unsubscribe(deliver, stop_idle=True)
+
+
+def serve_http(client, listen, workers=None, interval=10.0):
+    host, port = listen.rsplit(":", 1)
+    gateway = HttpGateway(client, workers=workers, interval=interval)
+    print("Serving http on " + listen, file=sys.stderr, flush=True)
+    try:
+        asyncio.run(gateway.serve(host.strip("[]"), port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.watcher.stop()
+        gateway.executor.shutdown(wait=False)
+
+
+class UsageError(Exception):
+    """A command the dispatcher rejects, missing or unknown arguments."""
+
+
+def run_get(args, client):
     result = None
     raw_result = None
-    if args.action == "get":
-        if args.object == "hardware":
-            result = get_hardware(args, creds)
-        elif args.object == "templates":
-            result = get_all_templates(args.tink_host, args.rpc_port, creds)
-        elif args.object == "template":
-            if args.template_name is not None:
-                raw_result = get_template_steps_by_name(args, creds, raw_result)
-            elif args.id is not None:
-                raw_result = get_template_steps(args.tink_host, args.rpc_port, creds,
-                                                template_id=args.id)
-            else:
-                print("Can't get template without template_name or id")
-        elif args.object == "workflows":
-            if args.host is not None:
-                result = get_workflows_by_host(args.tink_host, args.rpc_port,
-                                               creds, args.host)
-            else:
-                result = get_all_workflows(args.tink_host, args.rpc_port, creds)
-        elif args.object == "workflow":
-            if args.id is not None:
-                result = get_workflow_events(args.tink_host, args.rpc_port, creds,
-                                             workflow_id=args.id)
-            elif args.host is not None:
-                result = get_workflow_by_host(args.tink_host, args.rpc_port,
-                                              creds, args.host)
-            else:
-                print("Can't get workflow without host or id")
-        elif args.object == "workflow_contexts_by_hardware_id":
-            if args.id is not None:
-                result = get_workflow_by_hardware_id(args.tink_host, args.rpc_port,
-                                                     creds, hardware_id=args.id)
-            else:
-                print("Can't get workflow events without id")
+    if args.object == "hardware":
+        if args.id is not None:
+            result = client.get_hardware_id(args.id)
+        elif args.host is not None:
+            result = client.get_hardware_name(args.host)
         else:
-            print("Get object must be one of: hardware, templates, template, "
-                  "workflows, workflow, workflow_contexts_by_hardware_id")
-    elif args.action == "push":
-        if args.object == "workflow":
-            if args.host is not None and args.template_name is not None:
-                result = push_workflow(args.tink_host, args.rpc_port, creds,
-                                       args.host, args.template_name)
-                if args.reboot and \
-                        ipmi_userid is not None and ipmi_password is not None:
-                    hardware_info = get_hardware_name(args.tink_host, args.rpc_port,
-                                                      creds, "ipmi." + args.host)
-                    if hardware_info is not None:
-                        bmc = hardware_info['ip']
-                        ipmi_boot_pxe(host=bmc, username=ipmi_userid,
-                                      password=ipmi_password)
-            else:
-                print("Workflow push requires host and template_name args")
-        elif args.object == "hardware":
-            if args.file is not None:
-                result = push_hardware(args.tink_host, args.rpc_port, creds,
-                                       args.file)
-            else:
-                print("Hardware push requires file arg")
-        elif args.object == "template":
-            if args.file is not None:
-                result = push_template(args.tink_host, args.rpc_port, creds,
-                                       args.file)
-            else:
-                print("Template push requires file arg")
+            result = client.get_all_hardware()
+    elif args.object == "metadata":
+        hardware_id = args.id
+        if hardware_id is None and args.host is not None:
+            hardware_info = client.get_hardware_name(args.host)
+            if hardware_info is not None:
+                hardware_id = hardware_info['id']
+        if hardware_id is not None:
+            result = MessageToDict(client.get_hardware_metadata(hardware_id),
+                                   preserving_proto_field_name=True)
+        else:
+            raise UsageError("Can't get metadata without a known host or id")
+    elif args.object == "templates":
+        result = client.get_all_templates()
+    elif args.object == "template":
+        if args.template_name is not None:
+            raw_result = client.get_template_steps_by_name(args.template_name)
+        elif args.id is not None:
+            raw_result = client.get_template_steps(args.id)
+        else:
+            raise UsageError("Can't get template without template_name or id")
+    elif args.object == "workflows":
+        if args.host is not None:
+            result = client.get_workflows_by_host(args.host)
+        else:
+            result = client.get_all_workflows()
+        if args.state is not None:
+            result = [re for re in result if re['state'] == args.state]
+    elif args.object == "workflow":
+        if args.id is not None:
+            result = client.get_workflow_events(args.id)
+        elif args.host is not None:
+            result = client.get_workflow_by_host(args.host)
+        else:
+            raise UsageError("Can't get workflow without host or id")
+    elif args.object == "workflow_contexts_by_hardware_id":
+        if args.id is not None:
+            result = client.get_workflow_by_hardware_id(args.id)
+        else:
+            raise UsageError("Can't get workflow events without id")
+    else:
+        raise UsageError("Get object must be one of: hardware, metadata, templates, "
+                         "template, workflows, workflow, "
+                         "workflow_contexts_by_hardware_id")
+    return result, raw_result
+
+
+def run_push(args, client):
+    result = None
+    if args.object == "workflow":
+        if args.host is not None and args.template_name is not None:
+            result = client.push_workflow(args.host, args.template_name)
+            if args.reboot:
+                reboot_host(client, args.host)
+        else:
+            raise UsageError("Workflow push requires host and template_name args")
+    elif args.object == "hardware":
+        if args.file is not None:
+            result = client.push_hardware(args.file, workers=args.workers)
+        else:
+            raise UsageError("Hardware push requires file arg")
+    elif args.object == "template":
+        if args.file is not None:
+            result = client.push_template(args.file)
+        else:
+            raise UsageError("Template push requires file arg")
+    else:
+        raise UsageError("Push object must be one of: hardware, template, workflow")
+    return result
+
+
+def run_delete(args, client):
+    result = None
+    if args.object == "hardware":
+        if args.id is not None:
+            result = client.delete_hardware(args.id)
+        else:
+            raise UsageError("Hardware delete requires id arg")
+    elif args.object == "template":
+        if args.id is not None:
+            result = client.delete_template(args.id)
         else:
-            print("Push object must be one of: hardware, template, workflow")
+            raise UsageError("Template delete requires id arg")
+    elif args.object == "workflow":
+        if args.id is not None:
+            result = client.delete_workflow(args.id)
+        else:
+            raise UsageError("Workflow delete requires id arg")
+    else:
+        raise UsageError("Delete object must be one of: hardware, template, workflow")
+    return result
+
+
+def run_export(args, client):
+    if args.object not in EXPORT_COLUMNS:
+        raise UsageError("Export object must be one of: workflows, events")
+    elif args.format not in ("csv", "parquet", "arrow"):
+        raise UsageError("Export format must be one of: csv, parquet, arrow")
+    else:
+        count = client.export_records(args.object, args.format, args.output,
+                                      template_name=args.template_name,
+                                      since=parse_date(args.since),
+                                      until=parse_date(args.until))
+        if args.output is not None:
+            print("Exported " + str(count) + " " + args.object + " to "
+                  + args.output)
+
+
+def run_analyze(args, client):
+    result = None
+    if args.object == "actions":
+        result = client.analyze_actions(template_name=args.template_name,
+                                        since=parse_date(args.since),
+                                        until=parse_date(args.until))
+    else:
+        raise UsageError("Analyze object must be one of: actions")
+    return result
+
+
+def completion_script():
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'tink_complete.py')
+    return '''_tink_client() {
+    local kind
+    case "${COMP_WORDS[COMP_CWORD-1]}" in
+        --host) kind=host ;;
+        --template_name) kind=template ;;
+        --id) kind=id ;;
+        *) return 0 ;;
+    esac
+    COMPREPLY=($(%s -S %s "$kind" "${COMP_WORDS[COMP_CWORD]}"))
+}
+complete -F _tink_client tink_client.py
+''' % (shlex.quote(sys.executable), shlex.quote(script))
+
+
+def run_sync(args, client):
+    result = None
+    if args.dir is not None:
+        result = client.sync(args.dir, prune=args.prune, dry_run=args.dry_run,
+                             workers=args.workers)
+    else:
+        raise UsageError("Sync requires dir arg")
+    return result
+
+
+def run_wait(args, client):
+    result = None
+    if args.object != "workflows":
+        raise UsageError("Wait object must be: workflows")
+    elif args.id is not None:
+        result = client.wait_workflows(
+            [workflow_id.strip() for workflow_id in args.id.split(",")],
+            max_interval=args.interval)
+    elif args.hosts_file is not None:
+        hosts = read_hosts_file(args.hosts_file)
+        workflow_ids = client.get_active_workflow_ids(hosts)
+        result = client.wait_workflows(list(workflow_ids.values()),
+                                       max_interval=args.interval)
+        hosts_by_id = {v: k for k, v in workflow_ids.items()}
+        result = [dict(host=hosts_by_id[re['id']], **re) for re in result]
+        result.extend({'host': host, 'id': None, 'state': "Unknown",
+                       'current_action': None}
+                      for host in hosts if host not in workflow_ids)
+    else:
+        raise UsageError("Workflows wait requires id or hosts_file arg")
+    return result
+
+
+def run_provision(args, client):
+    result = None
+    if ipmi_userid is None or ipmi_password is None:
+        raise UsageError("Provision requires IPMI_USER and IPMI_PASS to PXE boot hosts")
+    if args.hosts_file is not None and args.template_name is not None:
+        state_file = args.state_file
+        if state_file is None:
+            state_file = args.hosts_file + ".state.json"
+        result = provision(client, read_hosts_file(args.hosts_file),
+                           args.template_name, args.max_running, state_file,
+                           interval=args.interval)
+    else:
+        raise UsageError("Provision requires hosts_file and template_name args")
+    return result
+
+
+def run_complete(args, client):
+    result = None
+    if args.object == "refresh":
+        result = client.refresh_indexes()
+    else:
+        raise UsageError("Complete object must be one of: refresh, bash")
+    return result
+
+
+def run_serve_http(args, client):
+    serve_http(client, args.listen, workers=args.workers, interval=args.interval)
+
+
+def run_watch(args, client):
+    if args.object != "workflows":
+        raise UsageError("Watch object must be: workflows")
+    hosts = None
+    if args.hosts_file is not None:
+        hosts = read_hosts_file(args.hosts_file)
+    elif args.host is not None:
+        hosts = [host.strip() for host in args.host.split(",")]
+    watcher = WorkflowWatcher(client, hosts=hosts, interval=args.interval)
+    hooks = None
+    if args.hooks_file is not None:
+        hooks = HookRunner.from_file(args.hooks_file, state_file=args.state_file,
+                                     workers=args.workers)
+        watcher.subscribe(hooks)
+    watcher.subscribe(lambda event: print(json.dumps(event), flush=True))
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if hooks is not None:
+            hooks.close()
+
+
+def dispatch(args, client):
+    result = None
+    raw_result = None
+    if args.action == "get":
+        result, raw_result = run_get(args, client)
+    elif args.action == "push":
+        result = run_push(args, client)
     elif args.action == "delete":
-        if args.object == "hardware":
-            if args.id is not None:
-                result = delete_hardware(args.tink_host, args.rpc_port, creds,
-                                         args.id)
-            else:
-                print("Hardware delete requires id arg")
-        elif args.object == "template":
-            if args.id is not None:
-                result = delete_template(args.tink_host, args.rpc_port, creds,
-                                         args.id)
-            else:
-                print("Template delete requires id arg")
-        elif args.object == "workflow":
-            if args.id is not None:
-                result = delete_workflow(args.tink_host, args.rpc_port, creds,
-                                         args.id)
-            else:
-                print("Workflow delete requires id arg")
+        result = run_delete(args, client)
+    elif args.action == "export":
+        run_export(args, client)
+    elif args.action == "analyze":
+        result = run_analyze(args, client)
+    elif args.action == "sync":
+        result = run_sync(args, client)
+    elif args.action == "provision":
+        result = run_provision(args, client)
+    elif args.action == "wait":
+        result = run_wait(args, client)
+    elif args.action == "serve-http":
+        run_serve_http(args, client)
+    elif args.action == "watch":
+        run_watch(args, client)
+    elif args.action == "complete":
+        result = run_complete(args, client)
+    else:
+        raise UsageError("Invalid action specified, must be one of: get, push, "
+                         "delete, sync, provision, wait, watch, serve-http, "
+                         "export, analyze, complete, batch")
+    return result, raw_result
+
+
+def batch_argv(parser, op):
+    # JSON operations are turned back into a command line so argparse converts
+    # and checks their values exactly as it does for typed commands
+    actions = {action.dest: action for action in parser._actions
+               if action.option_strings}
+    argv = []
+    for key, value in op.items():
+        if key in ('action', 'object'):
+            continue
+        action = actions.get(key)
+        if action is None:
+            raise ValueError("Unknown batch argument: " + key)
+        if action.nargs == 0:
+            if value:
+                argv.append(action.option_strings[-1])
+        elif value is not None:
+            argv.append(action.option_strings[-1] + "=" + str(value))
+    argv.extend(["--", str(op.get('action', ""))])
+    if op.get('object') is not None:
+        argv.append(str(op['object']))
+    return argv
+
+
+def batch_args(parser, args, line):
+    if line.startswith("{"):
+        op_args = parser.parse_args(batch_argv(parser, json.loads(line)))
+    else:
+        op_args = parser.parse_args(shlex.split(line))
+    for key in ('debug_logs', 'tink_host', 'rpc_port', 'http_port'):
+        setattr(op_args, key, getattr(args, key))
+    return op_args
+
+
+def run_batch(parser, args, client):
+    if args.file is not None:
+        commands = open(args.file)
+    else:
+        commands = sys.stdin
+    try:
+        for number, line in enumerate(commands, start=1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            out = {'line': number}
+            messages = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(messages):
+                    op_args = batch_args(parser, args, line)
+                    if op_args.action == "batch":
+                        raise ValueError("Nested batch is not supported")
+                    if isinstance(client, OfflineTinkClient) and \
+                            op_args.action != "get":
+                        raise ValueError("Only get can be run offline")
+                    result, raw_result = dispatch(op_args, client)
+                out['ok'] = True
+                out['result'] = as_dict(raw_result if raw_result is not None
+                                        else result)
+            except SystemExit:
+                out['ok'] = False
+                out['error'] = "Invalid command arguments"
+            except Exception as e:
+                out['ok'] = False
+                out['error'] = str(e)
+            if messages.getvalue() != "":
+                out['message'] = messages.getvalue().strip()
+            print(json.dumps(out, default=str), flush=True)
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+
+
+def load_sites(args):
+    sites = []
+    if args.sites_file is not None:
+        with open(args.sites_file) as my_file:
+            site_data = yaml.safe_load(my_file)
+        for site in site_data['sites']:
+            sites.append({
+                'name': site.get('name', site['host']),
+                'host': site['host'],
+                'rpc_port': str(site.get('rpc_port', args.rpc_port)),
+                'http_port': str(site.get('http_port', args.http_port)),
+                'channel': site.get('channel', {}),
+                'replicas': site.get('replicas', []),
+            })
+    elif args.tink_host is not None:
+        for host in args.tink_host.split(","):
+            sites.append({
+                'name': host.strip(),
+                'host': host.strip(),
+                'rpc_port': args.rpc_port,
+                'http_port': args.http_port,
+            })
+    return sites
+
+
+def print_stats(args, client):
+    if args.stats:
+        print(json.dumps(dict(site=client.name, **client.stats())), file=sys.stderr)
+
+
+def run_offline(args, site):
+    with OfflineTinkClient(site['host'], site['rpc_port']) as client:
+        result, raw_result = dispatch(args, client)
+        if client.staleness() is not None:
+            print(client.staleness(), file=sys.stderr)
+        print_stats(args, client)
+    return result, raw_result
+
+
+def tink_unavailable(e):
+    if isinstance(e, grpc.RpcError):
+        return e.code() in (grpc.StatusCode.UNAVAILABLE,
+                            grpc.StatusCode.DEADLINE_EXCEEDED)
+    return isinstance(e, OSError)
+
+
+def open_client(args, site):
+    policy = CallPolicy.from_args(args)
+    cache_ttl = parse_cache_ttl(args.cache_ttl)
+    if args.replay is not None:
+        channel = ReplayChannel(args.replay, latency=args.replay_latency)
+        return TinkClient(site['host'], site['rpc_port'], None,
+                          name="replay_" + site['host'], policy=policy,
+                          channel=channel, cache_ttl=cache_ttl)
+    interceptors = []
+    if args.record is not None:
+        interceptors.append(RecordingInterceptor(args.record))
+    settings = ChannelSettings.from_args(args, site.get('channel'))
+    return TinkClient.connect(site['host'], site['rpc_port'], site['http_port'],
+                              policy=policy, interceptors=interceptors,
+                              settings=settings, replicas=site.get('replicas', ()),
+                              cache_ttl=cache_ttl)
+
+
+def run_site(args, site):
+    if args.offline:
+        return run_offline(args, site)
+    try:
+        with open_client(args, site) as client:
+            result = dispatch(args, client)
+            print_stats(args, client)
+            return result
+    except (OSError, grpc.RpcError) as e:
+        if args.action != "get" or not tink_unavailable(e) or \
+                not os.path.exists(snapshot_path(site['host'], site['rpc_port'])):
+            raise
+        reason = e.details() if isinstance(e, grpc.RpcError) else str(e)
+        print("tink at " + site['host'] + " is unavailable (" + reason
+              + "), falling back to offline snapshot", file=sys.stderr)
+    return run_offline(args, site)
+
+
+def run_federated(args, sites):
+    with futures.ThreadPoolExecutor(max_workers=len(sites)) as executor:
+        pending = [(site['name'], executor.submit(run_site, args, site))
+                   for site in sites]
+        result = []
+        for name, future in pending:
+            try:
+                site_result, site_raw_result = future.result()
+            except Exception as e:
+                result.append({'site': name, 'error': str(e)})
+                continue
+            if site_raw_result is not None:
+                site_result = site_raw_result
+            site_result = as_dict(site_result)
+            if isinstance(site_result, list):
+                for re in site_result:
+                    if isinstance(re, dict):
+                        result.append(dict(site=name, **re))
+                    else:
+                        result.append({'site': name, 'result': re})
+            elif site_result is not None:
+                result.append({'site': name, 'result': site_result})
+    return result
+
+
+def run():
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.action == "complete" and args.object == "bash":
+        print(completion_script())
+        return
+
+    sites = load_sites(args)
+    if len(sites) == 0:
+        print("TINK_HOST environment variable must be set or --host must be specified")
+        return
+
+    if args.offline and args.action not in ("get", "batch"):
+        print("Only get can be run offline")
+        return
+
+    if len(sites) > 1:
+        if args.action != "get":
+            print("Only get can be run against multiple tink hosts")
+            return
+        if args.record is not None or args.replay is not None:
+            print("record and replay work against a single tink host")
+            return
+        result = run_federated(args, sites)
+        raw_result = None
+    elif args.action == "batch":
+        site = sites[0]
+        if args.offline:
+            client = OfflineTinkClient(site['host'], site['rpc_port'])
         else:
-            print("Delete object must be one of: hardware, template, workflow")
+            client = open_client(args, site)
+        with client:
+            run_batch(parser, args, client)
+            print_stats(args, client)
+        return
     else:
-        print("Invalid action specified, must be one of: get, push, delete")
+        try:
+            result, raw_result = run_site(args, sites[0])
+        except UsageError as e:
+            print(e)
+            return 2
+        except OfflineError as e:
+            print(e)
+            return 1
 
     if result is not None:
+        result = as_dict(result)
         if args.format == "json":
             print(json.dumps(result, indent=2))
         elif args.format == "yaml":
             print(yaml.dump(result, default_flow_style=False, sort_keys=False))
     if raw_result is not None:
         print(raw_result)
+    if args.action == "wait" and result is not None and \
+            any(re['state'] != "Success" for re in result):
+        return 1
 
 
 if __name__ == '__main__':
     logging.basicConfig()
-    run()
+    sys.exit(run())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SNAPSHOT_DIR = os.getenv('TINK_SNAPSHOT_DIR', os.path.join(
+    os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tink_client'))
+INDEX_KINDS = ('host', 'template', 'id')
+INDEX_TTL = int(os.getenv('TINK_COMPLETE_TTL', "300"))
+REFRESH_INTERVAL = 60
+MAX_MATCHES = 200
+
+
+def index_path(name, port, kind):
+    return os.path.join(SNAPSHOT_DIR, name + "_" + port + "." + kind + ".idx")
+
+
+def write_index(path, entries):
+    data = "\n".join(sorted(set(entry for entry in entries if entry))) + "\n"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path),
+                                     delete=False) as my_file:
+        my_file.write(data.encode())
+    os.replace(my_file.name, path)
+
+
+def lookup(path, prefix, limit=MAX_MATCHES):
+    try:
+        my_file = open(path, 'rb')
+    except OSError:
+        return []
+    with my_file:
+        if os.fstat(my_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(my_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            key = prefix.encode()
+            # lo and hi are always line starts, find the first line >= key
+            lo = 0
+            hi = len(data)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = data.rfind(b"\n", 0, mid) + 1
+                end = data.find(b"\n", start)
+                if end == -1:
+                    end = len(data)
+                if data[start:end] < key:
+                    lo = end + 1
+                else:
+                    hi = start
+            result = []
+            while lo < len(data) and len(result) < limit:
+                end = data.find(b"\n", lo)
+                if end == -1:
+                    end = len(data)
+                line = data[lo:end]
+                if not line.startswith(key):
+                    break
+                result.append(line.decode())
+                lo = end + 1
+    return result
+
+
+def refresh_in_background(name, port):
+    marker = os.path.join(SNAPSHOT_DIR, name + "_" + port + ".refreshing")
+    try:
+        if time.time() - os.path.getmtime(marker) < REFRESH_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(marker, 'w'):
+            pass
+    except OSError:
+        return
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'tink_client.py')
+    subprocess.Popen([sys.executable, script, "--tink_host", name,
+                      "--rpc_port", port, "complete", "refresh"],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def complete(kind, prefix, tink_host, port="42113"):
+    result = []
+    for name in tink_host.split(","):
+        name = name.strip()
+        path = index_path(name, port, kind)
+        try:
+            stale = time.time() - os.path.getmtime(path) > INDEX_TTL
+        except OSError:
+            stale = True
+        if stale:
+            refresh_in_background(name, port)
+        result.extend(lookup(path, prefix))
+    return sorted(set(result))
+
+
+def run():
+    if len(sys.argv) < 2 or sys.argv[1] not in INDEX_KINDS:
+        print("usage: tink_complete.py host|template|id [prefix]", file=sys.stderr)
+        return 2
+    tink_host = os.getenv('TINK_HOST')
+    if tink_host is None:
+        return 0
+    prefix = sys.argv[2] if len(sys.argv) > 2 else ""
+    port = os.getenv('TINK_RPC_PORT', "42113")
+    matches = complete(sys.argv[1], prefix, tink_host, port)
+    if matches:
+        print("\n".join(matches))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
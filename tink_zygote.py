@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+SOCKET_PATH = os.getenv('TINK_ZYGOTE_SOCKET', os.path.join(
+    os.getenv('XDG_RUNTIME_DIR', "/tmp"), "tink_client-" + str(os.getuid()) + ".sock"))
+HEADER = struct.Struct("!I")
+STATUS = struct.Struct("!i")
+
+
+def recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("zygote connection closed")
+        data += chunk
+    return data
+
+
+def exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def run_child(conn, request, fds):
+    import importlib
+    import logging
+
+    import tink_client
+    import tink_complete
+
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.argv = request['argv']
+    # settings read from the environment at import time follow the caller's env
+    importlib.reload(tink_complete)
+    tink_client.ipmi_userid = os.getenv('IPMI_USER')
+    tink_client.ipmi_password = os.getenv('IPMI_PASS')
+    conn.sendall(STATUS.pack(os.getpid()))
+    logging.basicConfig()
+    try:
+        code = exit_code(tink_client.run())
+    except SystemExit as e:
+        code = exit_code(e.code)
+    except KeyboardInterrupt:
+        code = 130
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    return code
+
+
+def serve():
+    # import everything the cli needs once, children inherit it on fork
+    import tink_client  # noqa: F401
+
+    try:
+        os.unlink(SOCKET_PATH)
+    except FileNotFoundError:
+        pass
+    os.umask(0o077)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(SOCKET_PATH)
+    listener.listen(64)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("tink zygote listening on " + SOCKET_PATH, file=sys.stderr, flush=True)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            uid = struct.unpack("3i", conn.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))[1]
+            if uid != os.getuid():
+                conn.close()
+                continue
+            fds = []
+            try:
+                size = HEADER.unpack(recv_exactly(conn, HEADER.size))[0]
+                request, fds, _, _ = socket.recv_fds(conn, size, 3)
+                request = json.loads(request + recv_exactly(conn, size - len(request)))
+            except (ConnectionError, ValueError) as e:
+                print("Bad zygote request: " + str(e), file=sys.stderr)
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+            if os.fork() == 0:
+                listener.close()
+                code = 1
+                try:
+                    code = run_child(conn, request, fds)
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    try:
+                        conn.sendall(STATUS.pack(code))
+                    except OSError:
+                        pass
+                    os._exit(code)
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(SOCKET_PATH)
+
+
+def launch(argv):
+    client = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tink_client.py')
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(SOCKET_PATH)
+    except OSError:
+        # no zygote running, start the cli the slow way
+        os.execv(sys.executable, [sys.executable, client] + argv)
+    request = json.dumps({'argv': [client] + argv, 'env': dict(os.environ),
+                          'cwd': os.getcwd()}).encode()
+    conn.sendall(HEADER.pack(len(request)))
+    socket.send_fds(conn, [request], [0, 1, 2])
+    pid = STATUS.unpack(recv_exactly(conn, STATUS.size))[0]
+
+    def forward(signum, frame):
+        os.kill(pid, signum)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, forward)
+    try:
+        return STATUS.unpack(recv_exactly(conn, STATUS.size))[0]
+    except ConnectionError:
+        return 1
+
+
+def run():
+    if sys.argv[1:2] == ["--zygote"]:
+        serve()
+        return 0
+    return launch(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(run())